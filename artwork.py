@@ -0,0 +1,113 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+import util
+import database
+
+# On-disk cover art cache. Files are named by a digest of the image URI,
+# sharded by the first two hex digits, and indexed in the artwork table
+# of discogs.db so the least recently used images can be evicted once
+# the store grows past max_bytes.
+store_dir = util.userfile("artwork")
+max_bytes = 512 * 1024 * 1024
+
+# Only bump last_access this often, reads shouldn't all turn into writes
+touch_interval = 3600
+
+# Images cached by older versions, named hex(hash(uri)) which changed
+# from run to run
+legacy_regex = re.compile(r"^0x[0-9a-f]+$")
+
+def artwork_key(uri):
+    return hashlib.sha256(uri.encode("utf-8")).hexdigest()
+
+def artwork_path(key):
+    return os.path.join(store_dir, key[:2], key)
+
+def load(uri):
+    """Return the cached image for uri, or None."""
+    key = artwork_key(uri)
+    path = artwork_path(key)
+    db = database.get_database()
+    try:
+        with open(path, "rb") as fo:
+            imgdata = fo.read()
+    except FileNotFoundError:
+        # evicted by another process, or never stored
+        if db.get_artwork(key):
+            db.delete_artwork(key)
+        return None
+
+    row = db.get_artwork(key)
+    if row is None:
+        db.put_artwork(key, uri, len(imgdata))
+    elif time.time() - row["last_access"] > touch_interval:
+        db.touch_artwork(key)
+    return imgdata
+
+def contains(uri):
+    return os.path.exists(artwork_path(artwork_key(uri)))
+
+def store(uri, imgdata):
+    return store_stream(uri, [imgdata])
+
+def store_stream(uri, chunks):
+    """Write an image to the store from an iterable of byte chunks,
+    without holding the whole image in memory. Returns its size."""
+    key = artwork_key(uri)
+    path = artwork_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary name and rename, so concurrent readers in
+    # other processes never see a partial file
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as fo:
+            for chunk in chunks:
+                fo.write(chunk)
+                size += len(chunk)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+    db = database.get_database()
+    db.put_artwork(key, uri, size)
+    if db.artwork_total_size() > max_bytes:
+        evict(keep=key)
+    return size
+
+def evict(limit=None, keep=None):
+    """Delete least recently used images until the store is under limit
+    (90% of max_bytes by default). Returns the number of bytes freed."""
+    if limit is None:
+        limit = max_bytes * 9 // 10
+    db = database.get_database()
+    total = db.artwork_total_size()
+    freed = 0
+    for row in db.artwork_lru():
+        if total - freed <= limit:
+            break
+        if row["key"] == keep:
+            continue
+        try:
+            os.unlink(artwork_path(row["key"]))
+        except FileNotFoundError:
+            pass
+        db.delete_artwork(row["key"])
+        freed += row["size"]
+    return freed
+
+def remove_legacy_files():
+    """Delete images cached under the old per-process hash names."""
+    count = 0
+    if not os.path.isdir(util.datapath):
+        return count
+    for fname in os.listdir(util.datapath):
+        if legacy_regex.match(fname):
+            os.unlink(util.userfile(fname))
+            count += 1
+    return count
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import synth
+from fakediscogs import FakeDiscogs
+
+# Run downloader.Downloader against a local FakeDiscogs with scripted
+# failures, and check each download ends up in a scratch artwork store:
+#
+#   python benchmarks/check_downloader.py
+#
+# Backoff delays are shortened to 0.1 s doubling per retry, so the
+# whole check takes a few seconds; Retry-After is honoured as sent.
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+
+# backoff_delay(attempt) in place of the jittered one
+BACKOFF = 0.1
+
+def main():
+    problems = []
+    with tempfile.TemporaryDirectory() as home, FakeDiscogs() as fake:
+        # before the repo's modules work out ~/.discogstool
+        os.environ["HOME"] = home
+        sys.path.insert(0, os.path.dirname(bench_dir))
+        import artwork
+        import downloader
+        import ratelimit
+
+        backoffs = []
+        def backoff_delay(attempt):
+            backoffs.append(attempt)
+            return BACKOFF * 2 ** attempt
+        ratelimit.backoff_delay = backoff_delay
+        # the fake's images aren't rate limited unless a check asks for it
+        ratelimit.image_limiter = ratelimit.TokenBucket(100, 100)
+
+        def uri(rid):
+            return "%s/images/R-%d.jpg" % (fake.url, rid)
+
+        def check(name, rid, faults=(), expect_error=False, min_secs=0.0,
+                expect_backoffs=None):
+            """Download image rid after faults; record any problems."""
+            fake.fail_image(rid, *faults)
+            before = dict(fake.counts)
+            del backoffs[:]
+            start = time.monotonic()
+            try:
+                size = downloader.Downloader(max_attempts=4).fetch(uri(rid))
+                error = None
+            except downloader.DownloadError as e:
+                size, error = None, e
+            secs = time.monotonic() - start
+            requests = sum(fake.counts.values()) - sum(before.values())
+
+            expected = synth.image_bytes(rid)
+            if expect_error:
+                if error is None:
+                    problems.append("%s: no DownloadError" % name)
+                if artwork.contains(uri(rid)):
+                    problems.append("%s: stored something anyway" % name)
+            elif error is not None:
+                problems.append("%s: %s" % (name, error))
+            elif size != len(expected) or artwork.load(uri(rid)) != expected:
+                problems.append("%s: the stored image isn't the one served" % name)
+            if requests != len(faults) + (not expect_error):
+                problems.append("%s: %d request(s), expected %d" %
+                        (name, requests, len(faults) + (not expect_error)))
+            if secs < min_secs:
+                problems.append("%s: retried after %.2f s, expected at least %.2f" %
+                        (name, secs, min_secs))
+            if expect_backoffs is not None and backoffs != expect_backoffs:
+                problems.append("%s: backed off for attempts %r, expected %r" %
+                        (name, backoffs, expect_backoffs))
+            print("%-28s %2d request(s) %6.2f s  %s" % (name, requests, secs,
+                    "error" if error else "%d bytes" % size))
+
+        check("200", 1)
+        # Retry-After: 1 beats the 0.1 s backoff
+        check("429 with Retry-After", 2, [429], min_secs=1.0)
+        check("5xx with backoff", 3, [503, 502], min_secs=BACKOFF * 3,
+                expect_backoffs=[0, 1])
+        check("connection reset", 4, ["reset"])
+        check("5xx on every attempt", 5, [503] * 4, expect_error=True)
+        check("404", 6, [404], expect_error=True)
+
+        # Requests for a uri already in flight share one download
+        fake.image_latency = 0.3
+        dl = downloader.Downloader()
+        before = fake.counts["image"]
+        futures = []
+        lock = threading.Lock()
+        def submit():
+            f = dl.submit(uri(7))
+            with lock:
+                futures.append(f)
+        threads = [threading.Thread(target=submit) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        sizes = set(f.result() for f in futures)
+        fake.image_latency = 0.0
+        if len(set(map(id, futures))) != 1 or fake.counts["image"] - before != 1:
+            problems.append("dedupe: %d future(s), %d request(s) for one uri" %
+                    (len(set(map(id, futures))), fake.counts["image"] - before))
+        if sizes != {len(synth.image_bytes(7))} or artwork.load(uri(7)) != synth.image_bytes(7):
+            problems.append("dedupe: the stored image isn't the one served")
+        print("%-28s %2d request(s) for %d submits" % ("in-flight dedupe",
+                fake.counts["image"] - before, len(futures)))
+
+    for problem in problems:
+        print(problem)
+    print("downloader: %d problem(s)" % len(problems))
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
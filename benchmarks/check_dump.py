@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+
+# Import the sample data dump in fixtures/ into a scratch HOME and check
+# what ends up in the release cache:
+#
+#   python benchmarks/check_dump.py
+#
+# The sample covers what the importer has to get right: artist name
+# variations, several labels, track artists (a compilation), headings
+# and index tracks (dropped), "Untitled" titles, empty image URIs,
+# unparseable release dates and importing only some releases (-c).
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sample = os.path.join(bench_dir, "fixtures", "sample_releases.xml.gz")
+
+# release id: expected fields, then (position, artist, title) per track
+EXPECTED = {
+    101: ({"artist": "Test Artist", "title": "First Album", "label": "Test Label",
+            "catno": "TL 001", "year": "1998", "genre": "House, Deep House",
+            "compilation": 0, "image_uri": "https://i.discogs.com/release-101.jpg"},
+        [("A1", "Test Artist", "Opening"), ("A2", "Test Artist", "Second Song"),
+            ("B1", "Test Artist", "Flip Side")]),
+    102: ({"artist": "Various", "title": "Compiled", "label": "Other Label / Sub Label",
+            "catno": "CMP 2 / CMP 2X", "year": "2004", "genre": "Techno",
+            "compilation": 1, "image_uri": None},
+        [("A", "Someone", "Track One"), ("B", "Someone Else", "Track Two")]),
+    103: ({"artist": "Mixer", "title": "MIX 3", "label": "Mix Label",
+            "catno": "MIX 3", "year": "0", "genre": "Ambient",
+            "compilation": 0, "image_uri": None},
+        [("2.", "Mixer", "MIX 3 2.")]),
+}
+# in the sample, but left out of the partial import
+LEFT_OUT = 104
+
+def check_release(client_interface, rid, problems):
+    fields, tracks = EXPECTED[rid]
+    try:
+        release = client_interface.get_release(rid)
+    except client_interface.ClientException as e:
+        problems.append("%d: not cached (%s)" % (rid, e))
+        return
+    for key, value in fields.items():
+        if release.fields[key] != value:
+            problems.append("%d: %s is %r, expected %r" % (rid, key, release.fields[key], value))
+    got = [(row["position"], row["artist"], row["title"]) for row in release.trackrows]
+    if got != tracks:
+        problems.append("%d: tracks are %r, expected %r" % (rid, got, tracks))
+
+def main():
+    problems = []
+    with tempfile.TemporaryDirectory() as home:
+        # before the repo's modules work out ~/.discogstool
+        os.environ["HOME"] = home
+        sys.path.insert(0, os.path.dirname(bench_dir))
+        import client_interface
+        import discogs_dump
+        client_interface.offline = True
+
+        count = discogs_dump.import_dump(sample, only=list(EXPECTED))
+        if count != len(EXPECTED):
+            problems.append("imported %d of the %d selected releases" % (count, len(EXPECTED)))
+        for rid in EXPECTED:
+            check_release(client_interface, rid, problems)
+        try:
+            client_interface.get_release(LEFT_OUT)
+            problems.append("%d: imported, but wasn't selected" % LEFT_OUT)
+        except client_interface.ClientException:
+            pass
+
+        count = discogs_dump.import_dump(sample)
+        if count != len(EXPECTED) + 1:
+            problems.append("imported %d releases from the whole sample, expected %d" %
+                    (count, len(EXPECTED) + 1))
+
+    for problem in problems:
+        print(problem)
+    print("%s: %d problem(s)" % (os.path.basename(sample), len(problems)))
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import synth
+
+# Check loudness.measure_wav against ffmpeg on the synthetic recordings
+# the benchmarks use:
+#
+#   python benchmarks/check_loudness.py
+#
+# Integrated loudness and its gate threshold are compared with ffmpeg's
+# ebur128 filter, which measures at the file's own rate like the meter
+# does. Loudness range and true peak are compared with loudnorm's pass 1,
+# since ebur128 takes a short-term block every 100 ms for LRA where
+# loudnorm (and libebur128) take one every second. ebur128 only prints
+# the threshold with one decimal, so it gets 0.05 more slack.
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+import loudness
+import encoder
+
+# (name, rate, bits, channels, seconds, seed)
+SIGNALS = [
+    ("44k-16bit-stereo", 44100, 16, 2, 40, 1),
+    ("48k-24bit-stereo", 48000, 24, 2, 40, 2),
+    ("96k-24bit-stereo", 96000, 24, 2, 30, 3),
+    ("44k-16bit-mono", 44100, 16, 1, 40, 4),
+]
+
+# stats field: (reference, allowed difference)
+TOLERANCE = {
+    "input_i": ("ebur128", 0.05),
+    "input_thresh": ("ebur128", 0.1),
+    "input_lra": ("loudnorm", 0.05),
+    "input_tp": ("loudnorm", 0.05),
+}
+# At 96 kHz the meter's interpolator keeps the band right up to Nyquist,
+# where ffmpeg's resampler rolls off, so it reads true peaks a little
+# higher on full-band noise
+TP_TOLERANCE_96K = 0.15
+
+metadata_regex = re.compile(r"lavfi\.r128\.I=(-?[0-9.]+)")
+threshold_regex = re.compile(r"^\s+Threshold:\s+(-?[0-9.]+)", re.M)
+
+def ebur128(path):
+    """ffmpeg's ebur128 reading of path, in the keys loudnorm uses."""
+    with tempfile.NamedTemporaryFile("r", suffix=".txt") as meta:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-nostats", "-i", path,
+                "-af", "ebur128=metadata=1,ametadata=mode=print:file=" + meta.name,
+                "-f", "null", "-"], capture_output=True, text=True, check=True)
+        # the last frame's running value, with 3 decimals
+        values = metadata_regex.findall(meta.read())
+    # the summary's first Threshold is the integrated loudness gate
+    return {"input_i": values[-1],
+            "input_thresh": threshold_regex.search(result.stderr).group(1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the in-process loudness meter with ffmpeg")
+    parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        print("%-18s %-13s %8s %8s %7s" % ("signal", "stat", "meter", "ffmpeg", "diff"))
+        for name, rate, bits, noc, secs, seed in SIGNALS:
+            path = os.path.join(tmp, name + ".wav")
+            synth.write_track(path, rate, bits, noc, secs, seed)
+            ours = loudness.measure_wav(path)
+            reference = {"ebur128": ebur128(path),
+                    "loudnorm": encoder.ffmpeg_loudness_stats(path)}
+            for field, (source, tolerance) in TOLERANCE.items():
+                if field == "input_tp" and rate > 48000:
+                    tolerance = TP_TOLERANCE_96K
+                value = float(ours[field])
+                ref = float(reference[source][field])
+                ok = abs(value - ref) <= tolerance + 1e-9
+                failures += not ok
+                print("%-18s %-13s %8.2f %8.2f %+7.2f %s" % (name, field, value, ref,
+                        value - ref, "" if ok else "off by more than %.2f" % tolerance))
+
+    if failures:
+        print("%d value(s) out of tolerance" % failures)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+
+# Compare two benchmark result files from run.py, e.g. before and after
+# a change:
+#
+#   git checkout main && python benchmarks/run.py -o before.json
+#   git checkout topic && python benchmarks/run.py -o after.json
+#   python benchmarks/compare.py before.json after.json
+
+def label(meta):
+    commit = (meta.get("commit") or "unknown")[:10]
+    return commit + ("+" if meta.get("dirty") else "")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("-t", "--threshold", type=float, default=5.0,
+            help="Only flag changes larger than this many percent (default: 5)")
+    parser.add_argument("--stat", choices=["median", "min", "mean"], default="median",
+            help="Statistic to compare (default: median)")
+    args = parser.parse_args()
+
+    with open(args.before) as fo:
+        before = json.load(fo)
+    with open(args.after) as fo:
+        after = json.load(fo)
+
+    print("%s -> %s (%s)" % (label(before["meta"]), label(after["meta"]), args.stat))
+    if before["meta"].get("options") != after["meta"].get("options"):
+        print("warning: the runs used different options")
+
+    names = list(before["results"]) + [n for n in after["results"] if n not in before["results"]]
+    width = max([len(n) for n in names] + [10])
+    regressions = 0
+    for name in names:
+        old = before["results"].get(name)
+        new = after["results"].get(name)
+        if not old or not new:
+            print("%-*s  %s" % (width, name, "only before" if old else "only after"))
+            continue
+        a, b = old[args.stat], new[args.stat]
+        change = (b - a) / a * 100 if a else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "slower"
+            regressions += 1
+        elif change < -args.threshold:
+            flag = "faster"
+        print("%-*s  %9.4fs %9.4fs %+7.1f%%  %s" % (width, name, a, b, change, flag))
+
+    # non-zero exit status when anything got slower, for scripts
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import re
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import synth
+
+# Local stand-in for the Discogs API and image CDN. Serves synthetic
+# releases and cover art with a configurable response latency, and
+# enforces a moving-window rate limit the way Discogs does: every
+# response carries X-Discogs-Ratelimit headers, and requests over the
+# limit get a 429. Failures can also be scripted per image, to check how
+# the downloader copes with them.
+
+release_regex = re.compile(r"^/releases/([0-9]+)$")
+image_regex = re.compile(r"^/images/R-([0-9]+)\.jpg$")
+
+class RateWindow:
+    """Requests allowed per `window` seconds, counted over a moving window."""
+
+    def __init__(self, limit, window=60.0):
+        self.limit = limit
+        self.window = window
+        self.stamps = collections.deque()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Record a request. Returns (allowed, used) with used counting
+        the requests in the current window."""
+        now = time.monotonic()
+        with self.lock:
+            while self.stamps and self.stamps[0] <= now - self.window:
+                self.stamps.popleft()
+            if self.limit and len(self.stamps) >= self.limit:
+                return False, len(self.stamps)
+            self.stamps.append(now)
+            return True, len(self.stamps)
+
+class FakeDiscogs:
+    def __init__(self, releases=(), latency=0.0, rate_limit=60,
+            image_latency=0.0, image_rate_limit=0, window=60.0, tracks=3):
+        self.releases = {}
+        self.latency = latency
+        self.image_latency = image_latency
+        self.api_window = RateWindow(rate_limit, window)
+        self.image_window = RateWindow(image_rate_limit, window)
+        self.rate_limit = rate_limit
+        self.tracks = tracks
+        self.counts = collections.Counter()
+        self.image_faults = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        # handler threads mustn't keep the process alive after stop()
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        for rid in releases:
+            self.add_release(rid)
+        self.thread = None
+
+    def add_release(self, rid, tracks=None):
+        self.releases[rid] = synth.release_data(rid, tracks or self.tracks, self.url)
+
+    def fail_image(self, rid, *faults):
+        """Answer the next requests for image rid with faults, in order:
+        an HTTP status (a 429 says Retry-After: 1) or "reset" to drop
+        the connection without a response."""
+        with self.lock:
+            self.image_faults[rid].extend(faults)
+
+    def next_fault(self, rid):
+        with self.lock:
+            faults = self.image_faults.get(rid)
+            return faults.pop(0) if faults else None
+
+    def count(self, what):
+        with self.lock:
+            self.counts[what] += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                name="fake-discogs", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, ctype, headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def reply_json(self, status, data, headers=()):
+                self.reply(status, json.dumps(data).encode(), "application/json", headers)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                m = release_regex.match(path)
+                if m:
+                    return self.release(int(m.group(1)))
+                m = image_regex.match(path)
+                if m:
+                    return self.image(int(m.group(1)))
+                fake.count("404")
+                self.reply_json(404, {"message": "The requested resource was not found."})
+
+            def release(self, rid):
+                time.sleep(fake.latency)
+                allowed, used = fake.api_window.take()
+                headers = [("X-Discogs-Ratelimit", str(fake.rate_limit)),
+                        ("X-Discogs-Ratelimit-Used", str(used)),
+                        ("X-Discogs-Ratelimit-Remaining", str(max(0, fake.rate_limit - used)))]
+                if not allowed:
+                    fake.count("429")
+                    return self.reply_json(429, {"message": "You are making requests too quickly."},
+                            headers)
+                if rid not in fake.releases:
+                    fake.count("404")
+                    return self.reply_json(404, {"message": "Release not found."}, headers)
+                fake.count("release")
+                self.reply_json(200, fake.releases[rid], headers)
+
+            def image(self, rid):
+                time.sleep(fake.image_latency)
+                allowed, used = fake.image_window.take()
+                if not allowed:
+                    fake.count("image 429")
+                    return self.reply(429, b"", "text/plain")
+                fault = fake.next_fault(rid)
+                if fault == "reset":
+                    fake.count("image reset")
+                    # linger 0 turns the close into a RST
+                    self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack("ii", 1, 0))
+                    self.close_connection = True
+                    return
+                if fault:
+                    fake.count("image %d" % fault)
+                    headers = [("Retry-After", "1")] if fault == 429 else []
+                    return self.reply(fault, b"", "text/plain", headers)
+                fake.count("image")
+                self.reply(200, synth.image_bytes(rid), "image/jpeg")
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Serve synthetic Discogs releases and images locally")
+    parser.add_argument("--releases", type=int, default=100,
+            help="Serve release ids 1..N (default: 100)")
+    parser.add_argument("--tracks", type=int, default=3,
+            help="Tracks per release (default: 3)")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="Seconds before every API response")
+    parser.add_argument("--rate-limit", type=int, default=60,
+            help="API requests per window, 0 for unlimited (default: 60)")
+    parser.add_argument("--image-latency", type=float, default=0.0,
+            help="Seconds before every image response")
+    parser.add_argument("--image-rate-limit", type=int, default=0,
+            help="Image requests per window, 0 for unlimited")
+    parser.add_argument("--window", type=float, default=60.0,
+            help="Rate limit window in seconds (default: 60)")
+    args = parser.parse_args()
+
+    fake = FakeDiscogs(range(1, args.releases + 1), args.latency, args.rate_limit,
+            args.image_latency, args.image_rate_limit, args.window, args.tracks)
+    print("Serving on %s, set DISCOGSTOOL_API_URL=%s" % (fake.url, fake.url))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(dict(fake.counts))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import importlib.machinery
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import synth
+from fakediscogs import FakeDiscogs
+
+# Benchmark runner. Every benchmark works on synthetic input generated
+# from a fixed seed in a scratch directory, with HOME pointed there so
+# the real ~/.discogstool is never touched, and anything that talks to
+# Discogs goes to a local FakeDiscogs. Results are written as JSON for
+# compare.py.
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+
+# (name, function, required tools) in registration order
+registry = []
+
+def benchmark(name, needs=()):
+    def register(fn):
+        registry.append((name, fn, needs))
+        return fn
+    return register
+
+def load_script(name):
+    """Import one of the extension-less scripts as a module."""
+    path = os.path.join(repo_dir, name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def write_auth(home):
+    datapath = os.path.join(home, ".discogstool")
+    os.makedirs(datapath, exist_ok=True)
+    with open(os.path.join(datapath, "discogs_auth"), "w") as fp:
+        fp.write("benchtoken|benchsecret")
+
+class Context:
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.home = os.path.join(workdir, "home")
+        self.inputs = os.path.join(workdir, "inputs")
+        self.track_secs = (8, 8, 8) if args.quick else (60, 60, 60)
+        self.files = {}
+        self.fake = None
+        os.makedirs(self.inputs)
+        write_auth(self.home)
+
+    def scratch(self, name):
+        """An empty directory, emptied again on every call."""
+        path = os.path.join(self.workdir, "scratch", name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def side(self, bits=16, noc=2, regions="cue", rid=1):
+        """Path of a generated multi-track side, named as dt_process expects."""
+        key = ("side", bits, noc, regions, rid)
+        if key not in self.files:
+            d = os.path.join(self.inputs, "%dbit-%dch-%s" % (bits, noc, regions))
+            os.makedirs(d, exist_ok=True)
+            path = os.path.join(d, "[r%d].wav" % rid)
+            synth.write_side(path, 44100, bits, noc, self.track_secs, regions, seed=rid)
+            self.files[key] = path
+        return self.files[key]
+
+    def track(self, bits=16, noc=2, rid=1, position="A1"):
+        key = ("track", bits, noc, rid, position)
+        if key not in self.files:
+            d = os.path.join(self.inputs, "%dbit-%dch-tracks" % (bits, noc))
+            os.makedirs(d, exist_ok=True)
+            path = os.path.join(d, "%d%s.wav" % (rid, position))
+            synth.write_track(path, 44100, bits, noc, self.track_secs[0], seed=rid)
+            self.files[key] = path
+        return self.files[key]
+
+    def encoded(self, fmt):
+        """A short track encoded by ffmpeg, for the tagging benchmarks."""
+        key = ("encoded", fmt)
+        if key not in self.files:
+            ext = {"aiff": ".aiff", "alac": ".m4a"}[fmt]
+            path = os.path.join(self.inputs, "encoded" + ext)
+            codec = {"aiff": "pcm_s16be", "alac": "alac"}[fmt]
+            subprocess.run(["ffmpeg", "-v", "quiet", "-y", "-i", self.track(),
+                "-acodec", codec, path], check=True)
+            self.files[key] = path
+        return self.files[key]
+
+    def cache_release(self, rid, tracks=3):
+        """Store a release (and its artwork) as if fetched from Discogs."""
+        data = synth.release_data(rid, tracks, "http://images.invalid")
+        artwork.store(data["images"][0]["uri"], synth.image_bytes(rid))
+        client_interface.store_release(client_interface.get_db(), rid,
+                client_interface.scrub_data(client_interface.project_release(data)))
+
+    def fake_discogs(self):
+        if not self.fake:
+            self.fake = FakeDiscogs(range(1, 1001), self.args.latency,
+                    self.args.rate_limit, self.args.image_latency,
+                    self.args.image_rate_limit).start()
+        return self.fake
+
+    def run_script(self, name, argv, home):
+        env = dict(os.environ, HOME=home, DISCOGSTOOL_API_URL=self.fake_discogs().url)
+        subprocess.run([sys.executable, os.path.join(repo_dir, name)] + argv,
+                env=env, check=True, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def import_repo():
+    """Import the modules under test once HOME points at the scratch home."""
+    global wavfile, loudness, database, client_interface, artwork, libtags, encoder, util, dt_process
+    sys.path.insert(0, repo_dir)
+    import wavfile
+    import loudness
+    import database
+    import client_interface
+    import artwork
+    import libtags
+    import encoder
+    import util
+    dt_process = load_script("dt_process")
+    # in-process benchmarks only ever use the local cache
+    client_interface.offline = True
+
+def configure_worker(ctx, **overrides):
+    config = dict(encoder.worker_config, tmpdir=ctx.scratch("tmp"))
+    config.update(overrides)
+    encoder.worker_init(config)
+    client_interface.offline = True
+
+#
+# wavfile
+#
+
+def bench_wav_read(ctx, bits, noc, mmap=False):
+    path = ctx.side(bits, noc)
+    if mmap:
+        # touching every sample, so the mapping is actually read
+        return lambda: wavfile.read(path, mmap=True)[1][:].max()
+    return lambda: wavfile.read(path)
+
+def bench_wav_scan(ctx):
+    path = ctx.side(24, 2, "ltxt")
+    return lambda: wavfile.scan(path)
+
+def bench_wav_write(ctx, bits, noc):
+    rate, data, _ = wavfile.read(ctx.side(bits, noc))
+    out = os.path.join(ctx.scratch("write"), "out.wav")
+    return lambda: wavfile.write(out, rate, data, bitrate=bits)
+
+for bits in (16, 24):
+    for noc in (1, 2):
+        name = "%dbit-%s" % (bits, "mono" if noc == 1 else "stereo")
+        benchmark("wavfile.read/" + name)(functools.partial(bench_wav_read, bits=bits, noc=noc))
+        benchmark("wavfile.write/" + name)(functools.partial(bench_wav_write, bits=bits, noc=noc))
+benchmark("wavfile.read/24bit-stereo-mmap")(functools.partial(bench_wav_read, bits=24, noc=2, mmap=True))
+benchmark("wavfile.scan")(bench_wav_scan)
+
+#
+# Splitting sides
+#
+
+def bench_split(ctx, bits, regions):
+    path = ctx.side(bits, 2, regions)
+    ctx.cache_release(1)
+    configure_worker(ctx)
+
+    def reset():
+        ctx.scratch("split")
+    return lambda: dt_process.split_wav_file(path, os.path.join(ctx.workdir, "scratch", "split"), 1), reset
+
+for bits in (16, 24):
+    for regions in ("cue", "ltxt", "smpl"):
+        benchmark("split_wav_file/%dbit-%s" % (bits, regions))(
+                functools.partial(bench_split, bits=bits, regions=regions))
+
+#
+# Loudness
+#
+
+def bench_measure(ctx, bits):
+    path = ctx.track(bits, 2)
+    return lambda: loudness.measure_wav(path)
+
+def bench_normalize(ctx, bits, cached=False, ffmpeg_analysis=False, fmt="aiff"):
+    path = ctx.track(bits, 2)
+    configure_worker(ctx, ffmpeg_analysis=ffmpeg_analysis, format=fmt)
+    out = os.path.join(ctx.scratch("normalize"), "out" + encoder.FORMAT_CONFIG[fmt]["ext"])
+
+    def reset():
+        if os.path.exists(out):
+            os.unlink(out)
+    if not cached:
+        return lambda: encoder.normalize_loudnorm(path, out), reset
+
+    # as dt_process does it: the stats are looked up, then handed to pass
+    # 2. It hashes each input once, for its manifest too
+    key = dt_process.analysis_key(util.file_digest(path))
+    dt_process.cache_loudness([key], [encoder.normalize_loudnorm(path, out)])
+    def run():
+        stats = dt_process.cached_loudness([key])
+        encoder.normalize_loudnorm(path, out, stats[0])
+    return run, reset
+
+for bits in (16, 24):
+    benchmark("loudness.measure_wav/%dbit-stereo" % bits)(functools.partial(bench_measure, bits=bits))
+benchmark("normalize_loudnorm/16bit-aiff", needs=("ffmpeg",))(
+        functools.partial(bench_normalize, bits=16))
+benchmark("normalize_loudnorm/24bit-aiff", needs=("ffmpeg",))(
+        functools.partial(bench_normalize, bits=24))
+benchmark("normalize_loudnorm/16bit-alac", needs=("ffmpeg",))(
+        functools.partial(bench_normalize, bits=16, fmt="alac"))
+benchmark("normalize_loudnorm/16bit-aiff-ffmpeg-analysis", needs=("ffmpeg",))(
+        functools.partial(bench_normalize, bits=16, ffmpeg_analysis=True))
+benchmark("normalize_loudnorm/16bit-aiff-cached", needs=("ffmpeg",))(
+        functools.partial(bench_normalize, bits=16, cached=True))
+
+#
+# Tagging
+#
+
+def bench_tag(ctx, fmt):
+    src = ctx.encoded(fmt)
+    ctx.cache_release(1)
+    track = client_interface.DiscogsTrack(client_interface.get_release(1), 0)
+    path = os.path.join(ctx.scratch("tag"), os.path.basename(src))
+
+    def run():
+        af = libtags.AudioFile(path, track, write_genre=True)
+        af.commit()
+
+    def reset():
+        shutil.copy(src, path)
+    return run, reset
+
+def bench_read_tags(ctx, fmt):
+    run, reset = bench_tag(ctx, fmt)
+    reset()
+    run()
+    path = os.path.join(ctx.workdir, "scratch", "tag", os.path.basename(ctx.encoded(fmt)))
+    # reading the release back from the comment tag, as dt_collection does
+    return lambda: libtags.AudioFile(path)
+
+for fmt in ("aiff", "alac"):
+    benchmark("libtags.AudioFile.commit/" + fmt, needs=("ffmpeg",))(
+            functools.partial(bench_tag, fmt=fmt))
+    benchmark("libtags.AudioFile.read/" + fmt, needs=("ffmpeg",))(
+            functools.partial(bench_read_tags, fmt=fmt))
+
+#
+# Database
+#
+
+def bench_db_put(ctx, count=500):
+    datas = [client_interface.scrub_data(client_interface.project_release(
+        synth.release_data(rid, 12, "http://images.invalid"))) for rid in range(10001, 10001 + count)]
+    db = client_interface.get_db()
+
+    def run():
+        with db.batch():
+            for data in datas:
+                client_interface.store_release(db, data["id"], data)
+    return run
+
+def bench_db_get(ctx, count=500, many=False):
+    bench_db_put(ctx, count)()
+    db = client_interface.get_db()
+    keys = [client_interface.release_key(rid) for rid in range(10001, 10001 + count)]
+    if many:
+        return lambda: db.get_many(keys)
+    return lambda: [db.get(key) for key in keys]
+
+benchmark("DiscogsDatabase.put/500-releases")(bench_db_put)
+benchmark("DiscogsDatabase.get/500-releases")(bench_db_get)
+benchmark("DiscogsDatabase.get_many/500-releases")(functools.partial(bench_db_get, many=True))
+
+#
+# Full runs, as separate processes against the fake Discogs
+#
+
+def full_inputs(ctx):
+    return [ctx.side(16, 2, "cue", 1), ctx.side(16, 2, "ltxt", 2),
+            ctx.side(24, 2, "smpl", 3), ctx.track(16, 2, 4, "A1"), ctx.track(24, 1, 5, "A1")]
+
+def bench_dt_process(ctx, options=(), warm=False):
+    inputs = full_inputs(ctx)
+    ctx.fake_discogs()
+    home = os.path.join(ctx.workdir, "scratch", "process-home")
+    argv = list(options) + ["-j", str(ctx.args.jobs), "-o"]
+
+    def fresh_home():
+        shutil.rmtree(home, ignore_errors=True)
+        write_auth(home)
+
+    def reset():
+        if not warm:
+            fresh_home()
+        ctx.scratch("process-out")
+
+    fresh_home()
+    if warm:
+        ctx.run_script("dt_process", argv + [ctx.scratch("process-out")] + inputs, home)
+    return lambda: ctx.run_script("dt_process",
+            argv + [os.path.join(ctx.workdir, "scratch", "process-out")] + inputs, home), reset
+
+def bench_dt_collection(ctx, warm=False):
+    inputs = full_inputs(ctx)
+    home = os.path.join(ctx.workdir, "scratch", "collection-home")
+    outdir = ctx.scratch("collection-media")
+    shutil.rmtree(home, ignore_errors=True)
+    write_auth(home)
+    ctx.run_script("dt_process", ["--single-pass", "-j", str(ctx.args.jobs), "-o", outdir] + inputs, home)
+    csv = os.path.join(ctx.workdir, "collection.csv")
+    synth.collection_csv(csv, range(1, 11))
+
+    def reset():
+        if not warm:
+            # keep the auth file, drop the cached metadata and artwork
+            datapath = os.path.join(home, ".discogstool")
+            for name in os.listdir(datapath):
+                if name != "discogs_auth":
+                    path = os.path.join(datapath, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.unlink(path)
+    return lambda: ctx.run_script("dt_collection", ["-a", "-c", csv, outdir], home), reset
+
+benchmark("dt_process/cold", needs=("ffmpeg",))(bench_dt_process)
+benchmark("dt_process/cold-single-pass", needs=("ffmpeg",))(
+        functools.partial(bench_dt_process, options=("--single-pass",)))
+benchmark("dt_process/warm", needs=("ffmpeg",))(functools.partial(bench_dt_process, warm=True))
+benchmark("dt_collection/cold", needs=("ffmpeg",))(bench_dt_collection)
+benchmark("dt_collection/warm", needs=("ffmpeg",))(functools.partial(bench_dt_collection, warm=True))
+
+#
+# Running and reporting
+#
+
+def git_describe():
+    def git(*argv):
+        try:
+            return subprocess.run(["git"] + list(argv), cwd=repo_dir, capture_output=True,
+                    text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {"commit": git("rev-parse", "HEAD"),
+            "subject": git("log", "-1", "--format=%s"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def tool_version(tool):
+    try:
+        out = subprocess.run([tool, "-version"], capture_output=True, text=True).stdout
+    except OSError:
+        return None
+    return out.splitlines()[0] if out else None
+
+def run_benchmark(ctx, fn):
+    setup = fn(ctx)
+    run, reset = setup if isinstance(setup, tuple) else (setup, None)
+    times = []
+    for i in range(ctx.args.repeat):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+parser = argparse.ArgumentParser(
+        description="Time discogstool on synthetic recordings and a local fake Discogs")
+parser.add_argument("-o", "--output", default="benchmark-results.json",
+        help="JSON file to write results to (default: benchmark-results.json)")
+parser.add_argument("-k", "--filter", action="append", default=[],
+        help="Only run benchmarks whose name contains this (can be repeated)")
+parser.add_argument("-r", "--repeat", type=int, default=5,
+        help="Timed runs per benchmark (default: 5)")
+parser.add_argument("-q", "--quick", action="store_true",
+        help="Short 8 second tracks instead of 60 seconds, for a fast smoke run")
+parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+        help="Jobs for the full dt_process runs (default: CPU count)")
+parser.add_argument("--latency", type=float, default=0.05,
+        help="Fake Discogs API latency in seconds (default: 0.05)")
+parser.add_argument("--rate-limit", type=int, default=60,
+        help="Fake Discogs API requests per minute (default: 60)")
+parser.add_argument("--image-latency", type=float, default=0.02,
+        help="Fake image CDN latency in seconds (default: 0.02)")
+parser.add_argument("--image-rate-limit", type=int, default=0,
+        help="Fake image CDN requests per minute, 0 for unlimited")
+parser.add_argument("--list", action="store_true",
+        help="List the benchmarks and exit")
+parser.add_argument("--keep", action="store_true",
+        help="Keep the scratch directory")
+
+def main():
+    args = parser.parse_args()
+    selected = [(name, fn, needs) for name, fn, needs in registry
+            if not args.filter or any(f in name for f in args.filter)]
+    if args.list:
+        for name, fn, needs in selected:
+            print(name)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="dt-bench-")
+    ctx = Context(args, workdir)
+    os.environ["HOME"] = ctx.home
+    import_repo()
+
+    results = {}
+    skipped = {}
+    try:
+        for name, fn, needs in selected:
+            missing = [tool for tool in needs if not shutil.which(tool)]
+            if missing:
+                skipped[name] = "%s not found" % ", ".join(missing)
+                print("%-48s skipped (%s)" % (name, skipped[name]))
+                continue
+            times = run_benchmark(ctx, fn)
+            results[name] = {"runs": times, "min": min(times),
+                    "median": statistics.median(times), "mean": statistics.mean(times)}
+            print("%-48s %9.4fs median %9.4fs min" % (name, results[name]["median"],
+                    results[name]["min"]))
+    finally:
+        if ctx.fake:
+            ctx.fake.stop()
+        if args.keep:
+            print("Scratch files kept in", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": dict(git_describe(),
+            date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=multiprocessing.cpu_count(),
+            ffmpeg=tool_version("ffmpeg"),
+            options={k: v for k, v in vars(args).items() if k not in ("output", "list", "keep", "filter", "repeat")}),
+        "results": results,
+        "skipped": skipped,
+    }
+    with open(args.output, "w") as fo:
+        json.dump(report, fo, indent=2)
+    print("Results written to", args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import struct
+import numpy
+
+# Synthetic recordings and Discogs data for the benchmarks. Everything
+# is generated from a fixed seed, so runs on different commits measure
+# exactly the same input.
+
+GAP_SECS = 2
+
+def _track_signal(rng, rate, noc, secs, index):
+    """A tone plus noise under a slow envelope, different for every track."""
+    t = numpy.arange(int(rate * secs)) / rate
+    env = 0.35 + 0.25 * numpy.sin(2 * numpy.pi * (0.05 + 0.01 * index) * t)
+    freq = 110.0 * (index + 2)
+    channels = []
+    for c in range(noc):
+        tone = numpy.sin(2 * numpy.pi * freq * (1 + 0.01 * c) * t)
+        channels.append(env * (0.6 * tone + 0.1 * rng.standard_normal(len(t))))
+    return numpy.stack(channels, axis=1)
+
+def side_signal(rate, noc, track_secs, seed=1):
+    """Float samples of a side: the tracks separated by near-silent gaps.
+    Returns (samples, [(start, end)] frames of every track)."""
+    rng = numpy.random.default_rng(seed)
+    parts = []
+    regions = []
+    pos = 0
+    for i, secs in enumerate(track_secs):
+        if i:
+            gap = int(rate * GAP_SECS)
+            parts.append(0.001 * rng.standard_normal((gap, noc)))
+            pos += gap
+        x = _track_signal(rng, rate, noc, secs, i)
+        parts.append(x)
+        regions.append((pos, pos + len(x)))
+        pos += len(x)
+    return numpy.clip(numpy.concatenate(parts), -1.0, 1.0), regions
+
+def pcm_bytes(x, bits):
+    if bits == 16:
+        return (x * 32767).astype("<i2").tobytes()
+    if bits == 24:
+        v = (x * (2 ** 23 - 1)).astype("<i4")
+        return v.view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+    raise ValueError("unsupported bit depth %d" % bits)
+
+def _chunk(cid, payload):
+    if len(payload) % 2:
+        payload += b"\x00"
+    return cid + struct.pack("<I", len(payload)) + payload
+
+def _cue_chunk(positions):
+    payload = struct.pack("<I", len(positions))
+    for i, pos in enumerate(positions):
+        payload += struct.pack("<II4sIII", i + 1, pos, b"data", 0, 0, pos)
+    return _chunk(b"cue ", payload)
+
+def _adtl_chunk(labels, lengths=None):
+    payload = b"adtl"
+    for i, label in enumerate(labels):
+        payload += _chunk(b"labl", struct.pack("<I", i + 1) + label.encode() + b"\x00")
+        if lengths:
+            payload += _chunk(b"ltxt", struct.pack("<II4sHHHH", i + 1, lengths[i],
+                b"rgn ", 0, 0, 0, 0))
+    return _chunk(b"LIST", payload)
+
+def _smpl_chunk(rate, loops):
+    payload = struct.pack("<iiiiIiiii", 0, 0, int(1e9 / rate), 60, 0, 0, 0,
+            len(loops), 0)
+    for i, (start, end) in enumerate(loops):
+        payload += struct.pack("<iiiiii", i + 1, 0, start, end, 0, 0)
+    return _chunk(b"smpl", payload)
+
+def write_side(path, rate=44100, bits=16, noc=2, track_secs=(40, 40, 40),
+        regions="cue", seed=1):
+    """Write a multi-track side as dt_process expects it from an editor.
+
+    regions picks how the track boundaries are stored:
+      "cue"  - cue points at the start of every track but the first
+      "ltxt" - cue points with region lengths in ltxt chunks
+      "smpl" - sampler loops, as Reaper exports regions
+    Returns the list of (start, end) track frames."""
+    x, tracks = side_signal(rate, noc, track_secs, seed)
+    data = pcm_bytes(x, bits)
+    ba = noc * bits // 8
+    fmt = struct.pack("<HHIIHH", 1, noc, rate, rate * ba, ba, bits)
+
+    chunks = [_chunk(b"fmt ", fmt), _chunk(b"data", data)]
+    if regions == "cue":
+        starts = [start for start, end in tracks[1:]]
+        chunks += [_cue_chunk(starts),
+                _adtl_chunk(["Track %d" % (i + 2) for i in range(len(starts))])]
+    elif regions == "ltxt":
+        chunks += [_cue_chunk([start for start, end in tracks]),
+                _adtl_chunk(["Track %d" % (i + 1) for i in range(len(tracks))],
+                    [end - start for start, end in tracks])]
+    elif regions == "smpl":
+        chunks.append(_smpl_chunk(rate, tracks))
+    elif regions is not None:
+        raise ValueError("unknown region style %r" % regions)
+
+    body = b"WAVE" + b"".join(chunks)
+    with open(path, "wb") as fo:
+        fo.write(b"RIFF" + struct.pack("<I", len(body)) + body)
+    return tracks
+
+def write_track(path, rate=44100, bits=16, noc=2, secs=40, seed=1):
+    """Write a single-track .wav."""
+    write_side(path, rate, bits, noc, (secs,), None, seed)
+
+def positions(count):
+    """Vinyl style positions: A1, A2, ... B1, B2, ..."""
+    per_side = max(1, (count + 1) // 2)
+    return ["%s%d" % ("AB"[i // per_side], i % per_side + 1) for i in range(count)]
+
+def release_data(rid, tracks=3, image_base=None):
+    """A release as the Discogs API returns it."""
+    data = {
+        "id": rid,
+        "title": "Benchmark Release %d" % rid,
+        "year": 2000 + rid % 25,
+        "styles": ["Deep House", "Techno"],
+        "genres": ["Electronic"],
+        "artists": [{"name": "Artist %d" % rid, "anv": "", "id": rid, "join": ""}],
+        "labels": [{"name": "Label %d" % (rid % 7), "catno": "BM%03d" % rid, "id": rid % 7}],
+        "tracklist": [{"position": p, "title": "Track %s" % p, "type_": "track",
+            "duration": "6:00"} for p in positions(tracks)],
+        "notes": "Synthetic release for benchmarks. " * 20,
+        "uri": "https://www.discogs.com/release/%d" % rid,
+    }
+    if image_base:
+        data["images"] = [{"type": "primary", "uri": "%s/images/R-%d.jpg" % (image_base, rid),
+            "width": 600, "height": 600}]
+    return data
+
+def image_bytes(rid, size=60000):
+    """Stand-in cover art: a JFIF header and end marker around noise,
+    enough for imghdr to call it a JPEG."""
+    rng = numpy.random.default_rng(rid)
+    head = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+    return head + rng.bytes(size - len(head) - 2) + b"\xff\xd9"
+
+def collection_csv(path, rids):
+    """A collection export as util.parse_collection_xml reads it."""
+    with open(path, "w") as fo:
+        fo.write("Catalog#,Artist,Title,Label,Format,Rating,Released,release_id,"
+                "CollectionFolder,Date Added,Collection Media Condition,"
+                "Collection Sleeve Condition,Collection Notes\n")
+        for rid in rids:
+            fo.write('BM%03d,Artist %d,Benchmark Release %d,Label %d,LP,,2000,%d,'
+                    'Uncategorized,2024-01-01 00:00:00,Mint (M),Mint (M),\n' %
+                    (rid, rid, rid, rid % 7, rid))
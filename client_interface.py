@@ -1,29 +1,37 @@
 #!/usr/bin/env python3
 
-import discogs_client
 import util
 import os
 import pprint
 import re
 import database
 import time
-import urllib.request, urllib.error, urllib.parse
 import sys
-import multiprocessing
 import threading
-import ctypes
-
+import concurrent.futures
+import queue
+import collections
+import ratelimit
+import artwork
+
+# discogs_client and downloader (urllib3) are imported where they're
+# used: runs answered from the local cache never need them
 discogs_auth = util.userfile("discogs_auth")
 useragent = "discogstool/2.0"
 consumer_key = "mWCofNBrngwtGCSBOTDe"
 consumer_secret = "nBgWYPSMtAonLobnAuZiowpJyUzhbcgW"
 cached_instance = None
 
-url_headers = {
-    'User-Agent' : useragent
-}
+# Alternative API root, e.g. the local stand-in in benchmarks/fakediscogs.py
+api_url = os.environ.get("DISCOGSTOOL_API_URL")
+
+# When set, only the local cache (e.g. an imported data dump) is used and
+# nothing is fetched from Discogs
+offline = False
 
-discogs_lock = multiprocessing.Lock()
+# Only guards creation of the shared client; requests themselves are
+# paced by the limiters in ratelimit
+client_lock = threading.Lock()
 
 class ClientException(Exception):
     pass
@@ -41,6 +49,7 @@ def get_user_auth_tokens():
         return None, None
 
 def set_user_auth_tokens(token, secret):
+    util.ensure_datapath()
     with open(discogs_auth, "w") as fp:
         fp.write("%s|%s" % (token, secret))
 
@@ -49,6 +58,13 @@ def get_client_instance():
     if cached_instance:
         return cached_instance
 
+    with client_lock:
+        if not cached_instance:
+            cached_instance = new_client_instance()
+    return cached_instance
+
+def new_client_instance():
+    import discogs_client
     token, secret = get_user_auth_tokens()
 
     if not token:
@@ -64,9 +80,87 @@ def get_client_instance():
     else:
         c = discogs_client.Client(useragent, consumer_key, consumer_secret,
                                 token, secret)
-    cached_instance = c
+    if api_url:
+        c._base_url = api_url.rstrip("/")
+    # 429s are handled by fetch_release, with a budget shared between threads
+    c.backoff_enabled = False
     return c
 
+def update_rate_limit(client):
+    fetcher = client._fetcher
+    ratelimit.api_limiter.update(getattr(fetcher, "rate_limit", None),
+            getattr(fetcher, "rate_limit_remaining", None))
+
+def fetch_release(rid, max_attempts=5):
+    if offline:
+        raise ClientException("release %d isn't in the local cache (offline)" % rid)
+
+    import discogs_client
+    client = get_client_instance()
+
+    # Even though rate limiting properly, still see transient
+    # "Connection Reset By Peer" and "Bad Status Line" errors
+    for i in range(max_attempts):
+        ratelimit.api_limiter.acquire()
+        try:
+            release = client.release(rid)
+            release.refresh()
+            return scrub_data(project_release(release.data))
+        except discogs_client.exceptions.HTTPError as e:
+            if e.status_code not in ratelimit.RETRY_STATUS:
+                raise ClientException("release %d couldn't be fetched: %s" % (rid, e))
+            if e.status_code == 429:
+                ratelimit.api_limiter.drain()
+        except Exception:
+            pass
+        finally:
+            update_rate_limit(client)
+        time.sleep(ratelimit.backoff_delay(i))
+
+    raise ClientException("release %d couldn't be fetched" % rid)
+
+def project_release(data):
+    """Reduce a full API response to the fields this tool reads."""
+    def artist(a):
+        return {"name": a.get("name", ""), "anv": a.get("anv", "")}
+
+    def track(t):
+        ret = {"position": t.get("position", ""), "title": t.get("title", ""),
+                "type_": t.get("type_", "")}
+        if "artists" in t:
+            ret["artists"] = [artist(a) for a in t["artists"]]
+        return ret
+
+    ret = {
+        "id": data.get("id"),
+        "title": data.get("title", ""),
+        "year": data.get("year", 0),
+        "styles": data.get("styles", []),
+        "artists": [artist(a) for a in data.get("artists", [])],
+        "labels": [{"name": l.get("name", ""), "catno": l.get("catno", "")}
+            for l in data.get("labels", [])],
+        "tracklist": [track(t) for t in data.get("tracklist", [])],
+    }
+    # Only the primary image is ever used for artwork
+    if data.get("images"):
+        ret["images"] = [{"uri": data["images"][0]["uri"]}]
+    return ret
+
+def compact_cache():
+    """Rewrite pickled full API responses in the database as projected,
+    compressed records."""
+    def transform(key, data):
+        if isinstance(key, str) and key.startswith("release-") and "tracklist" in data:
+            return scrub_data(project_release(data))
+        return data
+
+    count = get_db().migrate(transform)
+    print("Compacted %d cached record(s)." % count)
+    removed = artwork.remove_legacy_files()
+    if removed:
+        print("Removed %d image(s) cached under the old naming scheme." % removed)
+    return count
+
 def scrub_data(data):
     if isinstance(data, dict):
         for key, item in list(data.items()):
@@ -78,7 +172,305 @@ def scrub_data(data):
         return data.strip()
     return data
 
-threadlocal = threading.local()
+def filter_tracklist(tracklist):
+    # Filter out non-track items in the tracklist like headings
+    return [i for i in tracklist if i["type_"] == "track" and i["title"] != ""]
+
+def compile_list_data(items, keys):
+    if not items:
+        return ""
+
+    for key in keys:
+        s = items[0][key]
+        if s:
+            break
+
+    for i in items[1:]:
+        for key in keys:
+            x = i[key]
+            if x:
+                break
+        s = "%s / %s" % (s, x)
+    return s.strip()
+
+def normalize_position(position):
+    return position.upper().rstrip(".")
+
+def derive_release(rid, data):
+    """Flatten release data into a releases row and a list of tracks rows,
+    with all the derived strings the tagging code needs precomputed."""
+    tracklist = filter_tracklist(data["tracklist"])
+    artist = compile_list_data(data["artists"], ["anv", "name"])
+    catno = compile_list_data(data["labels"], ["catno"])
+    title = data["title"]
+    if title.startswith("Untitled"):
+        title = catno
+
+    tracks = []
+    for index, tdata in enumerate(tracklist):
+        if "artists" in tdata:
+            tartist = " / ".join(a["name"] for a in tdata["artists"]).strip()
+        else:
+            tartist = artist
+        ttitle = tdata["title"]
+        if ttitle.startswith("Untitled"):
+            ttitle = "%s %s" % (title, tdata["position"])
+        tracks.append({
+            "release_id": rid,
+            "idx": index,
+            "position": tdata["position"],
+            "norm_position": normalize_position(tdata["position"]),
+            "artist": tartist,
+            "title": ttitle,
+        })
+
+    images = data.get("images")
+    release = {
+        "id": rid,
+        "title": title,
+        "year": str(data["year"]),
+        "artist": artist,
+        "label": compile_list_data(data["labels"], ["name"]),
+        "catno": catno,
+        "genre": ", ".join(data["styles"]),
+        "compilation": int(len(set(t["artist"] for t in tracks)) > 1),
+        "total_tracks": len(tracks),
+        "image_uri": images[0]["uri"] if images else None,
+    }
+    return release, tracks
+
+def store_release(db, rid, data):
+    """Cache release data and materialize it in the releases/tracks tables."""
+    with db.batch():
+        db.put(release_key(rid), data)
+        db.put_release_rows(*derive_release(rid, data))
+
+# Release data resolved by prefetch_releases, keyed by release id, until
+# a DiscogsRelease takes it (and release_cache or the database has it)
+prefetched = {}
+
+def get_db():
+    return database.get_database()
+
+def release_key(rid):
+    return "release-%d" % rid
+
+def fetch_releases(rids, jobs=4):
+    """Fetch releases concurrently under the API rate limiter, yielding
+    (rid, data) as they complete. data is None if the fetch failed."""
+    with concurrent.futures.ThreadPoolExecutor(jobs) as ex:
+        futures = {ex.submit(fetch_release, rid): rid for rid in rids}
+        for future in concurrent.futures.as_completed(futures):
+            rid = futures[future]
+            try:
+                yield rid, future.result()
+            except ClientException as ce:
+                print(ce)
+                yield rid, None
+
+def prefetch_releases(rids, jobs=4):
+    """Resolve many releases up front so later DiscogsRelease() calls are
+    answered from memory. Cache hits come from a single batched query,
+    misses are fetched concurrently under the API rate limiter. Returns
+    the list of release ids that couldn't be fetched."""
+    rids = [rid for rid in dict.fromkeys(rids) if rid not in prefetched]
+    if not rids:
+        return []
+
+    db = get_db()
+    cached = db.get_many(release_key(rid) for rid in rids)
+    indexed = db.indexed_release_ids(rids)
+    missing = []
+    with db.batch():
+        for rid in rids:
+            data, age = cached.get(release_key(rid), (None, None))
+            if data and "tracklist" in data:
+                prefetched[rid] = data
+                # cached before the releases table existed
+                if rid not in indexed:
+                    db.put_release_rows(*derive_release(rid, data))
+                if db.is_stale(age):
+                    queue_refresh(rid)
+            else:
+                if data:
+                    db.delete(release_key(rid))
+                missing.append(rid)
+
+    if not missing:
+        return []
+
+    print("Fetching %d release(s) from Discogs..." % len(missing))
+    failed = []
+    for rid, data in fetch_releases(missing, jobs):
+        if data is None:
+            failed.append(rid)
+            continue
+        store_release(db, rid, data)
+        prefetched[rid] = data
+    return failed
+
+def prewarm_artwork(rids):
+    """Download the cover art of every release in rids that isn't in the
+    artwork store yet, concurrently on the shared downloader and under
+    the image rate limiter."""
+    rids = list(rids)
+    prefetch_releases(rids)
+    if offline:
+        return 0
+    uris = []
+    for rid in dict.fromkeys(rids):
+        try:
+            data = get_release(rid).data
+        except ClientException:
+            continue
+        if data.get("images"):
+            uri = data["images"][0]["uri"]
+            if not artwork.contains(uri):
+                uris.append(uri)
+    if not uris:
+        return 0
+
+    print("Fetching cover art for %d release(s)..." % len(uris))
+    import downloader
+    dl = downloader.get_downloader()
+    futures = {dl.submit(uri): uri for uri in uris}
+    count = 0
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            future.result()
+            count += 1
+        except downloader.DownloadError as err:
+            print(err)
+    return count
+
+# Stale cache entries are served immediately and re-fetched here in the
+# background (stale-while-revalidate)
+refresh_queue = queue.Queue()
+refresh_pending = set()
+refresh_lock = threading.Lock()
+refresh_thread = None
+
+def queue_refresh(rid):
+    global refresh_thread
+    if offline:
+        return
+    with refresh_lock:
+        if rid in refresh_pending:
+            return
+        refresh_pending.add(rid)
+        refresh_queue.put(rid)
+        if refresh_thread is None or not refresh_thread.is_alive():
+            refresh_thread = threading.Thread(target=refresh_worker,
+                    name="discogs-refresh", daemon=True)
+            refresh_thread.start()
+
+def refresh_worker():
+    while True:
+        rid = refresh_queue.get()
+        try:
+            data = fetch_release(rid)
+            store_release(get_db(), rid, data)
+            if rid in prefetched:
+                prefetched[rid] = data
+            # the next get_release() parses the fresh copy
+            release_cache.discard(rid)
+        except ClientException:
+            # keep serving the stale copy, we'll try again next run
+            pass
+        finally:
+            with refresh_lock:
+                refresh_pending.discard(rid)
+
+def refresh_stale_releases(max_age, batch_size=50, jobs=4):
+    """Re-fetch cached releases older than max_age days, writing each
+    batch in one transaction. Returns the release ids that failed."""
+    db = get_db()
+    rids = [int(key.split("-", 1)[1])
+            for key in db.keys_older_than("release-", max_age)]
+    if not rids:
+        print("No cached releases older than %d days." % max_age)
+        return []
+
+    print("Refreshing %d cached release(s) older than %d days..." %
+            (len(rids), max_age))
+    failed = []
+    done = 0
+    for i in range(0, len(rids), batch_size):
+        chunk = rids[i:i + batch_size]
+        results = list(fetch_releases(chunk, jobs))
+        with db.batch():
+            for rid, data in results:
+                if data is None:
+                    failed.append(rid)
+                    continue
+                store_release(db, rid, data)
+                prefetched.pop(rid, None)
+                release_cache.discard(rid)
+        done += len(chunk)
+        print("Refreshed %d/%d" % (done, len(rids)))
+    return failed
+
+class ReleaseCache:
+    """Process-wide LRU of DiscogsRelease objects, bounded by entry count
+    and by the total size of the artwork they hold."""
+
+    def __init__(self, max_entries=256, max_image_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_image_bytes = max_image_bytes
+        self.releases = collections.OrderedDict()
+        self.image_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, rid):
+        with self.lock:
+            rel = self.releases.get(rid)
+            if rel is not None:
+                self.releases.move_to_end(rid)
+                return rel
+
+        # Built outside the lock, may block on the database or the API
+        rel = DiscogsRelease(rid)
+        with self.lock:
+            if rid in self.releases:
+                # another thread got there first, share its object
+                self.releases.move_to_end(rid)
+                return self.releases[rid]
+            self.releases[rid] = rel
+            self.image_bytes += rel.artworkSize()
+            self._evict()
+        return rel
+
+    def artwork_loaded(self, rel, size):
+        with self.lock:
+            if self.releases.get(rel.rid) is rel:
+                self.image_bytes += size
+                self._evict()
+
+    def discard(self, rid):
+        """Forget rid, e.g. once a newer copy has been stored."""
+        with self.lock:
+            rel = self.releases.pop(rid, None)
+            if rel is not None:
+                self.image_bytes -= rel.artworkSize()
+
+    def _evict(self):
+        # never evict the most recently used entry
+        while len(self.releases) > 1 and (len(self.releases) > self.max_entries or
+                self.image_bytes > self.max_image_bytes):
+            rid, rel = self.releases.popitem(last=False)
+            self.image_bytes -= rel.artworkSize()
+
+    def clear(self):
+        with self.lock:
+            self.releases.clear()
+            self.image_bytes = 0
+
+release_cache = ReleaseCache()
+
+def get_release(rid):
+    """Shared DiscogsRelease for rid, so tracks of the same release reuse
+    one parsed record and one copy of its artwork."""
+    return release_cache.get(rid)
 
 class DiscogsRelease:
 
@@ -86,61 +478,40 @@ class DiscogsRelease:
         return self.data[key]
 
     def getData(self, rid):
-        db = getattr(threadlocal, "db", None)
-        if db is None:
-            db = database.DiscogsDatabase()
-            threadlocal.db = db
+        data = prefetched.pop(rid, None)
+        if data is not None:
+            return data
 
-        key = "release-%d" % rid
-        data = db.get(key)
+        db = get_db()
+        key = release_key(rid)
+        data, age = db.get_with_age(key)
         if data:
             if "tracklist" in data:
+                if db.is_stale(age):
+                    queue_refresh(rid)
                 return data
             else:
                 db.delete(key)
 
-        with discogs_lock:
-            client = get_client_instance()
-
-            # Even though rate limiting properly, still see transient
-            # "Connection Reset By Peer" and "Bad Status Line" errors
-            success = False
-            for i in range(3):
-                try:
-                    time.sleep(1.1 + (5 * i))
-                    release = client.release(rid)
-                    release.refresh()
-                except Exception as e:
-                    continue
-                success = True
-                break
-
-            if not success:
-                raise ClientException("release %d couldn't be fetched" % rid)
-
-        data = scrub_data(release.data)
-        db.put(key, data)
+        data = fetch_release(rid)
+        store_release(db, rid, data)
 
         return data
 
     def __init__(self, rid):
         self.rid = rid
-        self.data = scrub_data(self.getData(rid))
-
-        # Filter out non-track items in the tracklist like headings
-        self.data["tracklist"] = [i for i in self.data["tracklist"]
-                if i["type_"] == "track" and i["title"] != ""]
-        self.totaltracks = len(self.data["tracklist"])
+        # Cached and fetched data is already scrubbed. Copied, since the
+        # tracklist is filtered below
+        self.data = dict(self.getData(rid))
+
+        self.data["tracklist"] = filter_tracklist(self.data["tracklist"])
+        # Derived strings are computed once here rather than on every call
+        self.fields, self.trackrows = derive_release(rid, self.data)
+        self.totaltracks = self.fields["total_tracks"]
         self.imgdata = None
 
     def isCompilation(self):
-        art = self.getTrack(0).getArtist()
-
-        for i in range(1, self.getTotalTracks()):
-            if self.getTrack(i).getArtist() != art:
-                return True
-
-        return False
+        return bool(self.fields["compilation"])
 
     def getId(self):
         return self.rid
@@ -152,40 +523,38 @@ class DiscogsRelease:
         return DiscogsTrack(self, index)
 
     def getYear(self):
-        return str(self.data["year"])
+        return self.fields["year"]
 
     def compileListData(self, listname, keys):
-        for key in keys:
-            s = self.data[listname][0][key]
-            if s:
-                break
-
-        for i in self.data[listname][1:]:
-            for key in keys:
-                x = i[key]
-                if x:
-                    break
-            s = "%s / %s" % (s, x)
-        return s.strip()
+        return compile_list_data(self.data[listname], keys)
 
     def getArtist(self):
-        return self.compileListData("artists", ["anv", "name"])
+        return self.fields["artist"]
 
     def getLabel(self):
-        return self.compileListData("labels", ["name"])
+        return self.fields["label"]
 
     def getCatno(self):
-        return self.compileListData("labels", ["catno"])
+        return self.fields["catno"]
 
     def getGenre(self):
-        return ", ".join(self.data["styles"])
+        return self.fields["genre"]
 
     def getTitle(self):
-        rt = self.data["title"]
-        if not rt.startswith("Untitled"):
-            return rt
+        return self.fields["title"]
 
-        return self.getCatno()
+    def artworkSize(self):
+        return len(self.imgdata) if self.imgdata else 0
+
+    def prefetchArtwork(self):
+        """Start downloading the cover art in the background if it isn't
+        in the artwork store yet, so getArtwork() finds it ready."""
+        if offline or self.imgdata or not self.data.get("images"):
+            return
+        uri = self.data["images"][0]["uri"]
+        if not artwork.contains(uri):
+            import downloader
+            downloader.get_downloader().submit(uri)
 
     def getArtwork(self):
         if self.imgdata:
@@ -195,37 +564,19 @@ class DiscogsRelease:
             return None
 
         uri = self.data["images"][0]["uri"]
-        hashuri = hex(ctypes.c_uint64(hash(uri)).value)
-
-        with discogs_lock:
-            if os.path.exists(util.userfile(hashuri)):
-                with open(util.userfile(hashuri), "rb") as fo:
-                    imgdata = fo.read()
-            else:
-                count = 0
-                while (True):
-                    time.sleep(1.05)
-                    count = count + 1
-                    try:
-                        req = urllib.request.Request(uri, data=None, headers=url_headers)
-                        imgdata = urllib.request.urlopen(req).read()
-                        break
-                    except urllib.error.URLError as err:
-                        if (count < 5):
-                            continue
-                        else:
-                            raise
-                    except urllib.error.HTTPError as err:
-                        print("Error fetching cover art")
-                        print("URL: ", uri)
-                        print(err.code, err.reason)
-                        print(err.headers)
-                        raise
-
-                with open(util.userfile(hashuri), "wb") as fo:
-                    fo.write(imgdata)
+        imgdata = artwork.load(uri)
+        if imgdata is None:
+            if offline:
+                return None
+            import downloader
+            downloader.get_downloader().fetch(uri)
+            imgdata = artwork.load(uri)
+            if imgdata is None:
+                # the store couldn't keep it, or evicted it already
+                return None
 
         self.imgdata = imgdata
+        release_cache.artwork_loaded(self, len(imgdata))
         return imgdata
 
     def __repr__(self):
@@ -242,14 +593,14 @@ class DiscogsTrack:
     # Index is from 0
     def __init__(self, release, index):
         if isinstance(release, int):
-            self.release = DiscogsRelease(release)
+            self.release = get_release(release)
         else:
             self.release = release
         self.index = index
         try:
             self.tdata = self.release["tracklist"][index]
         except IndexError as ie:
-            raise ClientException("Release %d has no track %d" % (release, index))
+            raise ClientException("Release %d has no track %d" % (self.release.rid, index))
 
     def __repr__(self):
         return "<DiscogsTrack %d:%d>" % (self.release.rid, self.index)
@@ -264,20 +615,10 @@ class DiscogsTrack:
         return self.index + 1
 
     def getArtist(self):
-        if "artists" not in self.tdata:
-            return self.release.getArtist()
-
-        artiststr = self.tdata["artists"][0]["name"]
-        for artist in self.tdata["artists"][1:]:
-            artiststr = "%s / %s" % (artiststr, artist["name"])
-        return artiststr.strip()
+        return self.release.trackrows[self.index]["artist"]
 
     def getTitle(self):
-        t = self.tdata["title"]
-        if not t.startswith("Untitled"):
-            return t
-
-        return "%s %s" % (self.release.getTitle(), self.tdata["position"])
+        return self.release.trackrows[self.index]["title"]
 
     def getRelease(self):
         return self.release
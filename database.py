@@ -1,16 +1,40 @@
 import sqlite3
 import util
 import pickle
+import json
+import zlib
 import os
+import time
 import datetime
-import multiprocessing
+import threading
+import contextlib
+import ast
 
-db_lock = multiprocessing.Lock()
+# One connection per process, shared between threads (see get_database)
+_instance = None
+_instance_pid = None
+_instance_lock = threading.Lock()
+
+# Records are RECORD_MAGIC, a version byte, then zlib compressed JSON.
+# Anything else is a legacy pickled record, still readable until
+# migrate() rewrites it.
+RECORD_MAGIC = b"DTR"
+RECORD_VERSION = 1
+
+# Loudness analyses kept, least recently used ones are dropped beyond this
+max_loudness_entries = 50000
 
 def data2blob(data):
-    return sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    payload = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return sqlite3.Binary(RECORD_MAGIC + bytes([RECORD_VERSION]) +
+            zlib.compress(payload, 6))
+
+def is_current_blob(blob):
+    return bytes(blob[:4]) == RECORD_MAGIC + bytes([RECORD_VERSION])
 
 def blob2data(blob):
+    if bytes(blob[:3]) == RECORD_MAGIC:
+        return json.loads(zlib.decompress(blob[4:]))
     return pickle.loads(blob)
 
 def get_ts():
@@ -22,58 +46,211 @@ def ts_age(ts):
 
 class DiscogsDatabase:
     def __init__(self, max_age=7):
-        with db_lock:
-            db_file = util.userfile("discogs.db")
-            create_flag = not os.path.exists(db_file)
-            self.conn = sqlite3.connect(db_file)
-            # fetch rows as dictionaries
-            self.conn.row_factory = sqlite3.Row
-
-            # maximum data age
-            self.max_age = max_age
-
-            if create_flag:
-                print("Creating new database.")
-                c = self.conn.cursor()
-                c.execute('''CREATE TABLE responses (key TEXT PRIMARY KEY,
-                                                    last_update TEXT,
-                                                    data BLOB)''')
-                c.execute('''CREATE TABLE posted (id INTEGER PRIMARY KEY,
-                                                price REAL,
-                                                count INTEGER,
-                                                sales_hi REAL,
-                                                sales_lo REAL,
-                                                sales_avg REAL,
-                                                sales_mdn REAL,
-                                                date TEXT)''')
+        util.ensure_datapath()
+        db_file = util.userfile("discogs.db")
+        create_flag = not os.path.exists(db_file)
+        # Shared between threads, self.lock serializes access
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        # fetch rows as dictionaries
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+
+        # maximum data age
+        self.max_age = max_age
+
+        # WAL lets readers in other processes proceed while one writes,
+        # and with synchronous=NORMAL commits no longer fsync
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA mmap_size=268435456")
+        self.conn.execute("PRAGMA cache_size=-16384")
+
+        if create_flag:
+            print("Creating new database.")
+        # IF NOT EXISTS: another process may have created them in the meantime
+        c = self.conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY,
+                                            last_update TEXT,
+                                            data BLOB)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS posted (id INTEGER PRIMARY KEY,
+                                        price REAL,
+                                        count INTEGER,
+                                        sales_hi REAL,
+                                        sales_lo REAL,
+                                        sales_avg REAL,
+                                        sales_mdn REAL,
+                                        date TEXT)''')
+        # Index of the on-disk artwork store (see artwork.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS artwork (key TEXT PRIMARY KEY,
+                                        uri TEXT,
+                                        size INTEGER,
+                                        last_access INTEGER)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS artwork_last_access
+                                        ON artwork (last_access)''')
+        # Flattened releases and tracks with derived fields precomputed
+        c.execute('''CREATE TABLE IF NOT EXISTS releases (id INTEGER PRIMARY KEY,
+                                        title TEXT,
+                                        year TEXT,
+                                        artist TEXT,
+                                        label TEXT,
+                                        catno TEXT,
+                                        genre TEXT,
+                                        compilation INTEGER,
+                                        total_tracks INTEGER,
+                                        image_uri TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS tracks (release_id INTEGER,
+                                        idx INTEGER,
+                                        position TEXT,
+                                        norm_position TEXT,
+                                        artist TEXT,
+                                        title TEXT,
+                                        PRIMARY KEY (release_id, idx))''')
+        c.execute('''CREATE INDEX IF NOT EXISTS tracks_position
+                                        ON tracks (release_id, norm_position)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS releases_artist
+                                        ON releases (artist)''')
+        # Loudness analysis (loudnorm pass 1) results, keyed by a digest
+        # of the audio and the analysis parameters
+        c.execute('''CREATE TABLE IF NOT EXISTS loudness (key TEXT PRIMARY KEY,
+                                        stats TEXT,
+                                        last_access INTEGER)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS loudness_access
+                                        ON loudness (last_access)''')
+        # dt_process outputs, by input file, track and options (see manifest.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS manifest (source TEXT,
+                                        part TEXT,
+                                        options TEXT,
+                                        size INTEGER,
+                                        mtime INTEGER,
+                                        digest TEXT,
+                                        tags TEXT,
+                                        output TEXT,
+                                        completed INTEGER,
+                                        PRIMARY KEY (source, part, options))''')
+        self.conn.commit()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group writes into a single transaction, committed on exit.
+
+        Nests; only the outermost batch commits. Rolled back if the
+        block raises."""
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.conn.rollback()
+                raise
+            self.batch_depth -= 1
+            if not self.batch_depth:
                 self.conn.commit()
 
+    def _commit(self):
+        if not self.batch_depth:
+            self.conn.commit()
+
     def get(self, key):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM responses where key=?", (repr(key),))
-        r = c.fetchone()
+        data, age = self.get_with_age(key)
+        return data
+
+    def get_with_age(self, key):
+        """Returns (data, age in days), or (None, None) if not cached."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT * FROM responses where key=?", (repr(key),))
+            r = c.fetchone()
         if not r:
-            return None
-        return blob2data(r["data"])
+            return None, None
+        return blob2data(r["data"]), ts_age(r["last_update"])
+
+    def get_many(self, keys):
+        """Look up several keys at once, returns {key: (data, age in days)}
+        for the hits."""
+        keys = list(keys)
+        found = {}
+        # stay well under SQLITE_MAX_VARIABLE_NUMBER
+        for i in range(0, len(keys), 500):
+            chunk = {repr(k): k for k in keys[i:i + 500]}
+            with self.lock:
+                c = self.conn.cursor()
+                c.execute("SELECT * FROM responses WHERE key IN (%s)" %
+                        ",".join("?" * len(chunk)), list(chunk.keys()))
+                rows = c.fetchall()
+            for r in rows:
+                found[chunk[r["key"]]] = (blob2data(r["data"]),
+                        ts_age(r["last_update"]))
+        return found
+
+    def is_stale(self, age):
+        return bool(self.max_age) and age is not None and age > self.max_age
+
+    def keys_older_than(self, prefix, max_age):
+        """Keys starting with prefix that were stored more than max_age days ago."""
+        cutoff = str(datetime.date.today() - datetime.timedelta(days=max_age))
+        # keys are stored repr()'d, so match against the quoted prefix
+        pattern = repr(prefix)[:-1].replace("%", "\\%").replace("_", "\\_") + "%"
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT key FROM responses WHERE key LIKE ? ESCAPE '\\' "
+                    "AND last_update < ? ORDER BY last_update", (pattern, cutoff))
+            rows = c.fetchall()
+        return [ast.literal_eval(r["key"]) for r in rows]
+
+    def migrate(self, transform, chunk_size=200):
+        """Rewrite every record not in the current format, passing the
+        decoded data through transform(key, data) first, then VACUUM to
+        give the space back. Returns the number of records rewritten."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT key FROM responses")
+            keys = [r["key"] for r in c.fetchall()]
+
+        count = 0
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            with self.batch():
+                c = self.conn.cursor()
+                c.execute("SELECT key, data FROM responses WHERE key IN (%s)" %
+                        ",".join("?" * len(chunk)), chunk)
+                for r in c.fetchall():
+                    if is_current_blob(r["data"]):
+                        continue
+                    data = transform(ast.literal_eval(r["key"]), blob2data(r["data"]))
+                    # last_update is kept, migrating doesn't make data fresher
+                    c.execute("UPDATE responses SET data=? WHERE key=?",
+                            (data2blob(data), r["key"]))
+                    count += 1
+
+        if count:
+            with self.lock:
+                self.conn.execute("VACUUM")
+        return count
 
     def delete(self, key):
-        c = self.conn.cursor()
-        c.execute("DELETE FROM responses where key=?", (repr(key),))
-        self.conn.commit()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM responses where key=?", (repr(key),))
+            self._commit()
 
     def put(self, key, value):
-        c = self.conn.cursor()
         key = repr(key)
         b = data2blob(value)
         ts = get_ts()
-        c.execute("INSERT INTO responses VALUES (?,?,?)",
-                (key, ts, b))
-        self.conn.commit()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?)",
+                    (key, ts, b))
+            self._commit()
 
     def get_posted(self, releaseid):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM posted WHERE id=? ORDER BY date DESC", (releaseid,))
-        return c.fetchall()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT * FROM posted WHERE id=? ORDER BY date DESC", (releaseid,))
+            return c.fetchall()
 
     def get_last_posted(self, releaseid, max_age=0):
         results = self.get_posted(releaseid)
@@ -86,9 +263,158 @@ class DiscogsDatabase:
 
     def put_posted(self, releaseid, price, count, sales_hi,
                 sales_lo, sales_avg, sales_mdn):
-        c = self.conn.cursor()
         ts = get_ts()
-        c.execute("INSERT INTO posted VALUES (?,?,?,?,?,?,?,?)",
-                (releaseid, price, count, sales_hi, sales_lo,
-                    sales_avg, sales_mdn, ts))
-        self.conn.commit()
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT INTO posted VALUES (?,?,?,?,?,?,?,?)",
+                    (releaseid, price, count, sales_hi, sales_lo,
+                        sales_avg, sales_mdn, ts))
+            self._commit()
+
+    def put_release_rows(self, release, tracks):
+        """Replace the releases row and tracks rows of one release."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("""INSERT OR REPLACE INTO releases VALUES (:id, :title,
+                    :year, :artist, :label, :catno, :genre, :compilation,
+                    :total_tracks, :image_uri)""", release)
+            c.execute("DELETE FROM tracks WHERE release_id=?", (release["id"],))
+            c.executemany("""INSERT INTO tracks VALUES (:release_id, :idx,
+                    :position, :norm_position, :artist, :title)""", tracks)
+            self._commit()
+
+    def get_release_rows(self, ids):
+        """Returns {id: releases row} for the given release ids."""
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            with self.lock:
+                c = self.conn.cursor()
+                c.execute("SELECT * FROM releases WHERE id IN (%s)" %
+                        ",".join("?" * len(chunk)), chunk)
+                for r in c.fetchall():
+                    found[r["id"]] = r
+        return found
+
+    def indexed_release_ids(self, ids):
+        return set(self.get_release_rows(ids).keys())
+
+    def get_artwork(self, key):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT * FROM artwork WHERE key=?", (key,))
+            return c.fetchone()
+
+    def put_artwork(self, key, uri, size):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR REPLACE INTO artwork VALUES (?,?,?,?)",
+                    (key, uri, size, int(time.time())))
+            self._commit()
+
+    def touch_artwork(self, key):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("UPDATE artwork SET last_access=? WHERE key=?",
+                    (int(time.time()), key))
+            self._commit()
+
+    def delete_artwork(self, key):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM artwork WHERE key=?", (key,))
+            self._commit()
+
+    def artwork_total_size(self):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT COALESCE(SUM(size), 0) FROM artwork")
+            return c.fetchone()[0]
+
+    def artwork_lru(self):
+        """Artwork index rows, least recently used first."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT key, size FROM artwork ORDER BY last_access")
+            return c.fetchall()
+
+    def get_loudness(self, key):
+        """Returns the stored loudness stats dict for key, or None."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT stats FROM loudness WHERE key=?", (key,))
+            r = c.fetchone()
+            if not r:
+                return None
+            c.execute("UPDATE loudness SET last_access=? WHERE key=?",
+                    (int(time.time()), key))
+            self._commit()
+        return json.loads(r["stats"])
+
+    def put_loudness(self, key, stats):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR REPLACE INTO loudness VALUES (?,?,?)",
+                    (key, json.dumps(stats), int(time.time())))
+            self._commit()
+
+    def evict_loudness(self, limit=None):
+        """Drop the least recently used loudness analyses once there are
+        more than limit (max_loudness_entries by default), down to 90%.
+        Returns the number dropped."""
+        if limit is None:
+            limit = max_loudness_entries
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT COUNT(*) FROM loudness")
+            count = c.fetchone()[0]
+            if count <= limit:
+                return 0
+            drop = count - limit * 9 // 10
+            c.execute('''DELETE FROM loudness WHERE key IN
+                    (SELECT key FROM loudness ORDER BY last_access LIMIT ?)''', (drop,))
+            self._commit()
+        return drop
+
+    def get_manifest(self, source, part, options):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT * FROM manifest WHERE source=? AND part=? AND options=?",
+                    (source, part, options))
+            return c.fetchone()
+
+    def put_manifest(self, source, part, options, size, mtime, digest, tags, output):
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("INSERT OR REPLACE INTO manifest VALUES (?,?,?,?,?,?,?,?,?)",
+                    (source, part, options, size, mtime, digest, tags, output,
+                        int(time.time())))
+            self._commit()
+
+    def get_manifest_digest(self, source, size, mtime):
+        """Digest recorded for source at this size and mtime, if any."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("SELECT digest FROM manifest WHERE source=? AND size=? AND mtime=? LIMIT 1",
+                    (source, size, mtime))
+            row = c.fetchone()
+            return row[0] if row else None
+
+    def touch_manifest(self, source, mtime):
+        """Record a new mtime for a source whose content didn't change."""
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute("UPDATE manifest SET mtime=? WHERE source=?", (mtime, source))
+            self._commit()
+
+def get_database():
+    """Return this process's shared DiscogsDatabase, opening it on first use."""
+    global _instance, _instance_pid
+    # a forked child must not reuse its parent's connection
+    if _instance is None or _instance_pid != os.getpid():
+        with _instance_lock:
+            if _instance is None or _instance_pid != os.getpid():
+                _instance = DiscogsDatabase()
+                _instance_pid = os.getpid()
+    return _instance
@@ -0,0 +1,105 @@
+import gzip
+import xml.etree.ElementTree as ET
+import client_interface
+
+# Importer for the monthly Discogs data dumps
+# (https://data.discogs.com/, discogs_YYYYMMDD_releases.xml.gz).
+# Releases are streamed with iterparse and cleared as soon as they're
+# converted, so memory stays flat however big the dump is. Each release
+# is stored in the same projected shape as project_release() produces,
+# so DiscogsRelease can't tell an imported release from a fetched one.
+
+def open_dump(path):
+    with open(path, "rb") as fo:
+        magic = fo.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def _text(elem, tag):
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return ""
+    return child.text
+
+def _artists(elem):
+    return [{"name": _text(a, "name"), "anv": _text(a, "anv")}
+            for a in elem.findall("artists/artist")]
+
+def _track_type(elem):
+    # The dumps don't carry the API's type_ field
+    if elem.find("sub_tracks") is not None:
+        return "index"
+    if not _text(elem, "position") and not _text(elem, "duration"):
+        return "heading"
+    return "track"
+
+def parse_release(elem):
+    """Convert a <release> element to release data."""
+    released = _text(elem, "released")
+    year = int(released[:4]) if released[:4].isdigit() else 0
+
+    tracklist = []
+    for t in elem.findall("tracklist/track"):
+        track = {"position": _text(t, "position"), "title": _text(t, "title"),
+                "type_": _track_type(t)}
+        if t.find("artists") is not None:
+            track["artists"] = _artists(t)
+        tracklist.append(track)
+
+    data = {
+        "id": int(elem.get("id")),
+        "title": _text(elem, "title"),
+        "year": year,
+        "styles": [s.text or "" for s in elem.findall("styles/style")],
+        "artists": _artists(elem),
+        "labels": [{"name": l.get("name", ""), "catno": l.get("catno", "")}
+            for l in elem.findall("labels/label")],
+        "tracklist": tracklist,
+    }
+    # Recent dumps leave image URIs empty
+    for image in elem.findall("images/image"):
+        if image.get("uri") and image.get("type") == "primary":
+            data["images"] = [{"uri": image.get("uri")}]
+            break
+    return client_interface.scrub_data(data)
+
+def iter_releases(fo):
+    """Yield release data for every <release> in an open dump file."""
+    context = ET.iterparse(fo, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == "release":
+            yield parse_release(elem)
+            # drop everything parsed so far
+            root.clear()
+
+def import_dump(path, only=None, batch_size=1000):
+    """Import releases from a dump into the local cache. If only is given,
+    import just those release ids. Returns the number imported."""
+    if only is not None:
+        only = set(only)
+    db = client_interface.get_db()
+    count = 0
+    batch = []
+
+    def flush():
+        with db.batch():
+            for data in batch:
+                client_interface.store_release(db, data["id"], data)
+        del batch[:]
+
+    with open_dump(path) as fo:
+        for data in iter_releases(fo):
+            if only is not None and data["id"] not in only:
+                continue
+            batch.append(data)
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+                print("Imported %d releases..." % count)
+            if only is not None and count == len(only):
+                break
+    if batch:
+        flush()
+    return count
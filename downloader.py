@@ -0,0 +1,94 @@
+import concurrent.futures
+import threading
+import time
+import urllib3
+import ratelimit
+import artwork
+
+# Cover art downloads. Connections to the image CDN are kept alive in a
+# urllib3 pool and shared by a small set of download threads, paced by
+# ratelimit.image_limiter, so artwork never waits on (or holds up) the
+# metadata API.
+
+useragent = "discogstool/2.0"
+chunk_size = 64 * 1024
+
+class DownloadError(Exception):
+    pass
+
+class Downloader:
+    def __init__(self, workers=4, max_pending=64, max_attempts=5):
+        self.max_attempts = max_attempts
+        self.http = urllib3.PoolManager(maxsize=workers, retries=False,
+                headers={"User-Agent": useragent},
+                timeout=urllib3.Timeout(connect=10, read=30))
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers,
+                thread_name_prefix="artwork")
+        # bounds the queue, submit() blocks once this many are waiting
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def submit(self, uri):
+        """Queue uri for download into the artwork store. Returns a future
+        for its size; requests for a uri already in flight share one."""
+        with self.lock:
+            future = self.inflight.get(uri)
+            if future is not None:
+                return future
+        self.pending.acquire()
+        with self.lock:
+            future = self.inflight.get(uri)
+            if future is not None:
+                self.pending.release()
+                return future
+            future = self.executor.submit(self.download, uri)
+            self.inflight[uri] = future
+        future.add_done_callback(lambda f: self._done(uri))
+        return future
+
+    def _done(self, uri):
+        with self.lock:
+            self.inflight.pop(uri, None)
+        self.pending.release()
+
+    def fetch(self, uri):
+        """Download uri into the artwork store and wait for it."""
+        return self.submit(uri).result()
+
+    def download(self, uri):
+        for i in range(self.max_attempts):
+            last = i == self.max_attempts - 1
+            wait = 0.0
+            ratelimit.image_limiter.acquire()
+            try:
+                resp = self.http.request("GET", uri, preload_content=False)
+                try:
+                    if resp.status == 200:
+                        return artwork.store_stream(uri, resp.stream(chunk_size))
+                    if resp.status not in ratelimit.RETRY_STATUS or last:
+                        raise DownloadError("Error fetching cover art %s: %d %s" %
+                                (uri, resp.status, resp.reason))
+                    if resp.status == 429:
+                        ratelimit.image_limiter.drain()
+                    wait = ratelimit.retry_after(resp.headers.get("Retry-After"))
+                finally:
+                    # an unread error body would spoil the connection
+                    # for the next request on it
+                    resp.drain_conn()
+                    resp.release_conn()
+            except urllib3.exceptions.HTTPError as err:
+                # connection reset, timeout, truncated body...
+                if last:
+                    raise DownloadError("Error fetching cover art %s: %s" % (uri, err))
+            time.sleep(max(wait, ratelimit.backoff_delay(i)))
+
+_instance = None
+_instance_lock = threading.Lock()
+
+def get_downloader():
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = Downloader()
+    return _instance
@@ -0,0 +1,286 @@
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+
+# The part of dt_process that runs in its pool workers: normalizing and
+# encoding audio with ffmpeg. Workers are spawned, so everything imported
+# here is imported again by each of them; it's kept to the standard
+# library, with loudness (and numpy) imported when a file is measured.
+
+class ConversionException(Exception):
+    pass
+
+# Worker process configuration (set by pool initializer for spawn context)
+worker_config = {
+    'verbose': False,
+    'legacy_normalize': False,
+    'outdir': None,
+    'tmpdir': None,
+    'stagedir': None,
+    'format': 'aiff',
+    'write_genre': False,
+    'ffmpeg_analysis': False,
+    'ffmpeg_threads': 1,
+    'watch': False
+}
+
+# Format configuration
+FORMAT_CONFIG = {
+    'aiff': {'ext': '.aiff', 'codec': 'pcm_s16be', 'sample_fmt': 's16'},
+    'alac': {'ext': '.m4a', 'codec': 'alac', 'sample_fmt': 's16p'},
+}
+
+def worker_init(config):
+    """Initialize worker process with shared configuration."""
+    # updated in place, dt_process shares this dict
+    worker_config.update(config)
+    if config['watch']:
+        # A service manager's SIGTERM, or Ctrl-C, goes to the whole process
+        # group. A worker killed while waiting for a task takes the pool's
+        # queue lock with it, so leave stopping to the main process.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def debug(*strs):
+    if not worker_config['verbose']:
+        return
+    print(multiprocessing.current_process().name, strs)
+
+def new_tmp(ext, dir=None):
+    fo, tmppath = tempfile.mkstemp(suffix=ext, dir=dir or worker_config['tmpdir'])
+    os.close(fo)
+    debug("New temp %s file: %s" % (ext, tmppath))
+    return tmppath
+
+# EBU R128 target: -14 LUFS integrated, -1 dBTP, LRA 11
+LOUDNORM_TARGET = "I=-14:TP=-1:LRA=11"
+
+# Stats of one named loudnorm instance (loudnorm@rN) in ffmpeg's stderr
+loudnorm_regex = re.compile(r"\[loudnorm@r([0-9]+) @ [^\]]*\]\s*(\{.*?\})", re.S)
+
+def loudnorm_filter(stats):
+    """Pass 2 loudnorm filter applying the measured stats from pass 1."""
+    return (
+        f"loudnorm={LOUDNORM_TARGET}:"
+        f"measured_I={stats['input_i']}:"
+        f"measured_TP={stats['input_tp']}:"
+        f"measured_LRA={stats['input_lra']}:"
+        f"measured_thresh={stats['input_thresh']}:"
+        f"offset={stats['target_offset']}:"
+        f"linear=true"
+    )
+
+def loudnorm_linear(stats):
+    """Whether pass 2 keeps loudnorm in linear mode (one gain for the
+    whole track) with these stats, by the checks af_loudnorm itself
+    makes. Otherwise it falls back to dynamic mode, which also applies
+    pass 1's target_offset. Without input_tp, whether it still can."""
+    target = dict(kv.split("=") for kv in LOUDNORM_TARGET.split(":"))
+    measured_i = float(stats['input_i'])
+    measured_lra = float(stats['input_lra'])
+    if not (measured_i != 0 and float(stats['input_thresh']) != -70 and
+            0 < measured_lra <= float(target['LRA'])):
+        return False
+    if 'input_tp' not in stats:
+        return True
+    measured_tp = float(stats['input_tp'])
+    offset_tp = measured_tp + (float(target['I']) - measured_i)
+    return measured_tp != 99 and offset_tp <= float(target['TP'])
+
+def encode_args():
+    fmt = FORMAT_CONFIG[worker_config['format']]
+    return ["-acodec", fmt['codec'], "-sample_fmt", fmt['sample_fmt'], "-ar", "44100"]
+
+def thread_args():
+    """Keep an ffmpeg run, analysis or encode, to its share of the thread
+    budget, rather than a thread per CPU for every one of the -j of them.
+    The filter graph is where the threads go: the pcm and alac encoders
+    are single threaded."""
+    threads = str(worker_config['ffmpeg_threads'])
+    return ["-filter_threads", threads, "-filter_complex_threads", threads]
+
+def ffmpeg_loudness_stats(path):
+    # Pass 1 as a separate ffmpeg run
+    result = subprocess.run([
+        "ffmpeg", "-hide_banner"] + thread_args() + ["-i", path,
+        "-af", f"loudnorm={LOUDNORM_TARGET}:print_format=json",
+        "-f", "null", "-"
+    ], capture_output=True, text=True)
+
+    # Parse the JSON output from stderr (ffmpeg outputs to stderr)
+    # The JSON is at the end of the output after the loudnorm stats
+    output = result.stderr
+    json_start = output.rfind('{')
+    json_end = output.rfind('}') + 1
+    if json_start == -1 or json_end == 0:
+        raise ConversionException("Failed to parse loudnorm analysis output")
+
+    try:
+        stats = json.loads(output[json_start:json_end])
+    except json.JSONDecodeError as e:
+        debug("loudnorm output:", output)
+        raise ConversionException(f"Failed to parse loudnorm JSON: {e}")
+    return stats
+
+def measure_loudness(path):
+    """Measure the loudness of a file. WAV files are measured in-process,
+    anything else (or --ffmpeg-analysis) goes through ffmpeg."""
+    if not worker_config['ffmpeg_analysis'] and path.lower().endswith(".wav"):
+        import loudness
+        try:
+            # the true peak is only worth measuring if pass 2 can stay linear
+            stats = loudness.measure_wav(path, peak_if=loudnorm_linear)
+            if stats and loudnorm_linear(stats):
+                return stats
+            # only loudnorm's own pass 1 knows its dynamic mode's offset
+            debug("Not linear, measuring with ffmpeg:", stats)
+        except ValueError as e:
+            debug("In-process loudness analysis failed, using ffmpeg:", e)
+    return ffmpeg_loudness_stats(path)
+
+# Two-pass EBU R128 loudness normalization using ffmpeg. Pass 1 is
+# skipped if the stats are given. Returns the stats used.
+def normalize_loudnorm(path, tmpout, stats=None):
+    if stats is None:
+        debug("Analyzing loudness (pass 1)...")
+        stats = measure_loudness(path)
+    debug("Loudness stats:", stats)
+
+    # Pass 2: Apply normalization with measured values and convert to output format
+    debug(f"Normalizing and converting to 44.1/16 {worker_config['format'].upper()} (pass 2)...")
+
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "panic"] + thread_args() + [
+        "-y", "-i", path,
+        "-af", loudnorm_filter(stats),
+    ] + encode_args() + [tmpout]
+
+    retval = subprocess.call(cmd)
+
+    if retval:
+        raise ConversionException("Loudnorm normalization failed")
+    return stats
+
+# Legacy peak normalization using normalize-audio
+def normalize_legacy(path):
+    debug("Normalizing (legacy peak mode)...")
+    norm_exe = "normalize-audio"
+    # Ubuntu calls it normalize-audio, but homebrew normalize. Same program.
+    if shutil.which(norm_exe) is None:
+        norm_exe = "normalize"
+        if shutil.which(norm_exe) is None:
+            raise ConversionException("missing normalize utility")
+
+    retval = subprocess.call([norm_exe, "-q", "-T", "1.5", "--peak", path])
+    if retval:
+        raise ConversionException("Normalization failed")
+
+# Normalize and encode a file to a temp file in the output format. ffmpeg
+# reads any input it knows straight from where it is; in legacy mode
+# path is normalized in place, so it must be a .wav copy.
+# Returns (temp file, loudness stats or None in legacy mode).
+def encode_file(path, stats=None):
+    fmt = FORMAT_CONFIG[worker_config['format']]
+    tmpout = new_tmp(fmt['ext'], worker_config['stagedir'])
+
+    if worker_config['legacy_normalize']:
+        normalize_legacy(path)
+        debug(f"Converting to 44.1/16 {worker_config['format'].upper()}...")
+        cmd = ["ffmpeg", "-hide_banner", "-loglevel", "panic"] + thread_args() + [
+                "-y", "-i", path] + encode_args() + [tmpout]
+        retval = subprocess.call(cmd)
+        if retval:
+            raise ConversionException("Encoding failed")
+    else:
+        # EBU R128 loudnorm (default) - normalizes and converts in one step
+        stats = normalize_loudnorm(path, tmpout, stats)
+
+    return tmpout, stats
+
+def decode_flac(path):
+    tmpwav = new_tmp(".wav")
+    debug("Converting to intermediate .wav...")
+    retval = subprocess.call(["flac", "--silent", "-f", "-d", "-o", tmpwav, path])
+    if retval:
+        raise ConversionException("FLAC decoding failed")
+    return tmpwav
+
+def side_graph(bounds, chains):
+    """filter_complex feeding frames bounds[i] of the side through
+    chains[i] to [o<i>]."""
+    graph = ["[0:a]asplit=%d%s" % (len(bounds), "".join("[s%d]" % i for i in range(len(bounds))))]
+    for i, (start, end) in enumerate(bounds):
+        graph.append("[s%d]atrim=start_sample=%d:end_sample=%d,asetpts=PTS-STARTPTS,%s[o%d]" %
+                (i, start, end, chains[i], i))
+    return ";".join(graph)
+
+# Normalize and encode the [(start, end)] frames of each track of a side
+# straight from the source file, with one ffmpeg run for all the pass 1
+# analyses (unless stats are given) and one that writes all the outputs.
+# No intermediate WAVs are written. Returns (temp files, stats), in
+# track order.
+def encode_side(src, bounds, stats=None):
+    if stats is None:
+        debug("Analyzing loudness of %d regions of %s (pass 1)..." % (len(bounds), src))
+        stats = measure_side_loudness(src, bounds)
+    debug("Loudness stats:", stats)
+
+    debug(f"Normalizing and converting to 44.1/16 {worker_config['format'].upper()} (pass 2)...")
+    fmt = FORMAT_CONFIG[worker_config['format']]
+    chains = [loudnorm_filter(s) for s in stats]
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "panic"] + thread_args() + [
+            "-y", "-i", src, "-filter_complex", side_graph(bounds, chains)]
+    outputs = []
+    for i in range(len(bounds)):
+        tmpout = new_tmp(fmt['ext'], worker_config['stagedir'])
+        outputs.append(tmpout)
+        cmd += ["-map", "[o%d]" % i] + encode_args() + [tmpout]
+    if subprocess.call(cmd):
+        raise ConversionException("Loudnorm normalization failed for %s" % src)
+    return outputs, stats
+
+def measure_side_loudness(src, bounds):
+    """Pass 1 for the [(start, end)] frames of each track of a side."""
+    if not worker_config['ffmpeg_analysis']:
+        import loudness
+        try:
+            stats = [loudness.measure_wav(src, start, end, peak_if=loudnorm_linear)
+                    for start, end in bounds]
+        except ValueError as e:
+            debug("In-process loudness analysis failed, using ffmpeg:", e)
+        else:
+            # tracks loudnorm won't keep linear need its own pass 1, for
+            # the offset its dynamic mode applies
+            redo = [i for i, s in enumerate(stats) if not (s and loudnorm_linear(s))]
+            if redo:
+                debug("Not linear, measuring %d region(s) with ffmpeg" % len(redo))
+                for i, s in zip(redo, ffmpeg_side_stats(src, [bounds[i] for i in redo])):
+                    stats[i] = s
+            return stats
+    return ffmpeg_side_stats(src, bounds)
+
+def ffmpeg_side_stats(src, bounds):
+    # Pass 1 for every region, as one separate ffmpeg run
+    chains = ["loudnorm@r%d=%s:print_format=json" % (i, LOUDNORM_TARGET)
+            for i in range(len(bounds))]
+    cmd = ["ffmpeg", "-hide_banner", "-nostats"] + thread_args() + ["-i", src,
+            "-filter_complex", side_graph(bounds, chains)]
+    for i in range(len(bounds)):
+        cmd += ["-map", "[o%d]" % i, "-f", "null", "-"]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+
+    stats = {}
+    for m in loudnorm_regex.finditer(result.stderr):
+        try:
+            stats[int(m.group(1))] = json.loads(m.group(2))
+        except json.JSONDecodeError as e:
+            raise ConversionException(f"Failed to parse loudnorm JSON: {e}")
+    if len(stats) != len(bounds):
+        debug("loudnorm output:", result.stderr)
+        raise ConversionException("Failed to parse loudnorm analysis output for %s" % src)
+    return [stats[i] for i in range(len(bounds))]
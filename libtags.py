@@ -1,12 +1,10 @@
 import mutagen
 import sys
 import pprint
-import urllib.request, urllib.parse, urllib.error
 import os.path
 import shutil
 import filecmp
 import re
-import imghdr
 from mutagen.id3 import ID3
 from mutagen.mp4 import MP4Cover
 import client_interface
@@ -67,7 +65,8 @@ def track_from_comment(comment, index):
     if not m:
         raise TagsException("comment '%s' doesn't specify a release" % comment)
 
-    return client_interface.DiscogsTrack(int(m.groups()[0]), index - 1)
+    release = client_interface.get_release(int(m.groups()[0]))
+    return client_interface.DiscogsTrack(release, index - 1)
 
 
 class AudioFile(object):
@@ -163,6 +162,7 @@ class AudioFile(object):
                 value = clazz(encoding=3, desc="", lang='eng', text=value)
             elif mkey == "APIC":
                 self.obj.tags.delall("APIC")
+                import imghdr
                 mimetype = "image/" + imghdr.what(None, h=value)
                 value = clazz(type=0, encoding=0, mime=mimetype, data=value)
             else:
@@ -0,0 +1,236 @@
+import math
+import numpy
+import wavfile
+
+# In-process EBU R128 / ITU-R BS.1770 loudness measurement, returning the
+# same stats as a pass 1 run of ffmpeg's loudnorm filter (input_i,
+# input_tp, input_lra, input_thresh, target_offset) without decoding the
+# file in a separate process.
+#
+# Gating and block timing follow libebur128, which ffmpeg's ebur128 code
+# is a port of: 400 ms momentary blocks every 100 ms for integrated
+# loudness, 3 s short-term blocks every second for loudness range.
+# benchmarks/check_loudness.py compares it with ffmpeg on the benchmark
+# recordings: integrated loudness and threshold agree with the ebur128
+# filter to within 0.05 LU, LRA and true peak with loudnorm's pass 1 to
+# within 0.05 (true peak reads up to 0.15 dB higher at 96 kHz). loudnorm's
+# integrated loudness reads up to ~0.3 LU lower on bright material, since
+# it resamples to 192 kHz first.
+# Samples are streamed in chunks, so memory use doesn't depend on the
+# file length.
+
+# Frames per chunk; leaves room in a 2**19 point FFT for the K-weighting
+# impulse response, which is 0.25 s long (48000 taps at 192 kHz)
+chunk_frames = 7 << 16
+
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+LRA_RELATIVE_GATE = -20.0
+
+# Identifies this meter in analysis cache keys; bump when results change
+ANALYZER = "bs1770/2"
+
+# Supported format tags: PCM and IEEE float
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+def energy_to_loudness(energy):
+    if energy <= 0:
+        return -math.inf
+    return 10 * math.log10(energy) - 0.691
+
+def k_weighting(rate):
+    """Combined K-weighting filter (shelf then RLB high-pass) as (b, a),
+    with the coefficients libebur128 derives for any sample rate."""
+    f0 = 1681.974450955533
+    G = 3.999843853973347
+    Q = 0.7071752369554196
+    K = math.tan(math.pi * f0 / rate)
+    Vh = math.pow(10.0, G / 20.0)
+    Vb = math.pow(Vh, 0.4996667741545416)
+    a0 = 1.0 + K / Q + K * K
+    pb = [(Vh + Vb * K / Q + K * K) / a0, 2.0 * (K * K - Vh) / a0,
+            (Vh - Vb * K / Q + K * K) / a0]
+    pa = [1.0, 2.0 * (K * K - 1.0) / a0, (1.0 - K / Q + K * K) / a0]
+
+    f0 = 38.13547087602444
+    Q = 0.5003270373238773
+    K = math.tan(math.pi * f0 / rate)
+    rb = [1.0, -2.0, 1.0]
+    ra = [1.0, 2.0 * (K * K - 1.0) / (1.0 + K / Q + K * K),
+            (1.0 - K / Q + K * K) / (1.0 + K / Q + K * K)]
+    return numpy.convolve(pb, rb), numpy.convolve(pa, ra)
+
+def impulse_response(b, a, length):
+    # Direct form recurrence, only run once per file
+    h = numpy.zeros(length)
+    x = numpy.zeros(length)
+    x[0] = 1.0
+    order = len(a)
+    for n in range(length):
+        acc = 0.0
+        for k in range(order):
+            if n - k < 0:
+                break
+            acc += b[k] * x[n - k]
+            if k:
+                acc -= a[k] * h[n - k]
+        h[n] = acc
+    return h
+
+class _Convolver:
+    """Streaming overlap-add FFT convolution of every channel with h."""
+
+    def __init__(self, h, noc):
+        self.taps = len(h)
+        self.nfft = 1 << int(math.ceil(math.log2(chunk_frames + self.taps - 1)))
+        self.H = numpy.fft.rfft(h, self.nfft)
+        self.tail = numpy.zeros((self.taps - 1, noc))
+
+    def feed(self, x):
+        n = len(x)
+        y = numpy.fft.irfft(numpy.fft.rfft(x, self.nfft, axis=0) *
+                self.H[:, None], self.nfft, axis=0)[:n + self.taps - 1]
+        y[:self.taps - 1] += self.tail
+        self.tail = y[n:].copy()
+        return y[:n]
+
+def true_peak_filter(factor, zero_crossings=16):
+    """Polyphase windowed-sinc interpolator, one row of taps per phase."""
+    taps = 2 * zero_crossings * factor
+    n = numpy.arange(taps) - (taps - 1) / 2.0
+    h = numpy.sinc(n / factor) * numpy.kaiser(taps, 8.0)
+    return h.reshape(-1, factor).T
+
+class _TruePeak:
+    """Peak of the signal oversampled to about 192 kHz, like loudnorm."""
+
+    def __init__(self, rate, noc):
+        self.factor = max(1, int(round(192000.0 / rate)))
+        self.phases = true_peak_filter(self.factor)
+        self.history = numpy.zeros((self.phases.shape[1] - 1, noc))
+        self.peak = 0.0
+
+    def feed(self, x):
+        self.peak = max(self.peak, float(numpy.abs(x).max()) if len(x) else 0.0)
+        if self.factor == 1:
+            return
+        xp = numpy.concatenate((self.history, x))
+        for c in range(xp.shape[1]):
+            for phase in self.phases:
+                y = numpy.convolve(xp[:, c], phase, 'valid')
+                if len(y):
+                    self.peak = max(self.peak, float(numpy.abs(y).max()))
+        self.history = xp[len(xp) - len(self.history):]
+
+def _samples(data, bits, comp, start, end):
+    """Yield float64 (frames, channels) chunks in [-1, 1)."""
+    for pos in range(start, end, chunk_frames):
+        x = numpy.asarray(data[pos:min(pos + chunk_frames, end)], dtype=numpy.float64)
+        if x.ndim == 1:
+            x = x[:, None]
+        if comp == WAVE_FORMAT_IEEE_FLOAT:
+            yield x
+        elif bits == 8:
+            yield (x - 128.0) / 128.0
+        else:
+            yield x / float(2 ** (bits - 1))
+
+class _Gating:
+    """Gated integrated loudness and loudness range of the K-weighted
+    signal, in 100 ms segments as libebur128 keeps them."""
+
+    def __init__(self, rate, noc):
+        b, a = k_weighting(rate)
+        self.kfilter = _Convolver(impulse_response(b, a, int(rate * 0.25)), noc)
+        self.seg = (rate + 5) // 10         # frames per 100 ms, as libebur128
+        self.segments = []                  # summed channel energy per 100 ms
+        self.rest = numpy.zeros((0, noc))
+
+    def feed(self, x):
+        y = numpy.concatenate((self.rest, self.kfilter.feed(x)))
+        whole = len(y) // self.seg * self.seg
+        if whole:
+            self.segments.append((y[:whole] ** 2).sum(axis=1).reshape(-1, self.seg).sum(axis=1))
+        self.rest = y[whole:]
+
+    def stats(self):
+        seg = self.seg
+        segments = numpy.concatenate(self.segments) if self.segments else numpy.zeros(0)
+
+        # 400 ms blocks every 100 ms
+        csum = numpy.concatenate(([0.0], numpy.cumsum(segments)))
+        momentary = (csum[4:] - csum[:-4]) / (4 * seg)
+        # 3 s blocks every second
+        short_term = (csum[30::10] - csum[:-30:10]) / (30 * seg) if len(segments) >= 30 else numpy.zeros(0)
+
+        abs_energy = 10 ** ((ABSOLUTE_GATE + 0.691) / 10)
+        gated = momentary[momentary >= abs_energy]
+        if len(gated):
+            thresh_energy = gated.mean() * 10 ** (RELATIVE_GATE / 10)
+            integrated = gated[gated >= thresh_energy]
+            input_i = energy_to_loudness(integrated.mean())
+            input_thresh = energy_to_loudness(thresh_energy)
+        else:
+            input_i = -math.inf
+            input_thresh = ABSOLUTE_GATE
+
+        st = short_term[short_term >= abs_energy]
+        input_lra = 0.0
+        if len(st):
+            st = numpy.sort(st[st >= st.mean() * 10 ** (LRA_RELATIVE_GATE / 10)])
+            if len(st):
+                hi = st[int((len(st) - 1) * 0.95 + 0.5)]
+                lo = st[int((len(st) - 1) * 0.1 + 0.5)]
+                input_lra = energy_to_loudness(hi) - energy_to_loudness(lo)
+
+        # Clamped to the ranges loudnorm accepts for its measured_* options.
+        # target_offset is the gain loudnorm's dynamic mode would still miss
+        # the target by after pass 1, which takes running that mode to know.
+        # It's only ignored if pass 2 stays linear: see
+        # encoder.loudnorm_linear, which sends the other tracks to ffmpeg.
+        return {
+            "input_i": "%.2f" % min(0.0, max(-99.0, input_i)),
+            "input_lra": "%.2f" % min(99.0, max(0.0, input_lra)),
+            "input_thresh": "%.2f" % min(0.0, max(-99.0, input_thresh)),
+            "target_offset": "0.00",
+        }
+
+def _input_tp(tp):
+    input_tp = 20 * math.log10(tp.peak) if tp.peak > 0 else -math.inf
+    return "%.2f" % min(99.0, max(-99.0, input_tp))
+
+def measure_samples(chunks, rate, noc):
+    """Loudness stats for an iterable of float (frames, channels) chunks."""
+    gating = _Gating(rate, noc)
+    tp = _TruePeak(rate, noc)
+    for x in chunks:
+        gating.feed(x)
+        tp.feed(x)
+    return dict(gating.stats(), input_tp=_input_tp(tp))
+
+def measure_wav(path, start=0, end=None, peak_if=None):
+    """Loudness stats of frames [start, end) of a WAV file.
+
+    The true peak takes as long as the rest together. With peak_if, it's
+    measured in a second read of the frames, and only if peak_if accepts
+    the other stats; None is returned if it doesn't."""
+    info = wavfile.scan(path)
+    if info.comp not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+        raise ValueError("Unsupported WAV format %d" % info.comp)
+    rate, data, bits = wavfile.read(path, mmap=True)
+    end = len(data) if end is None else min(end, len(data))
+    if peak_if is None:
+        return measure_samples(_samples(data, bits, info.comp, start, end), rate, info.noc)
+
+    gating = _Gating(rate, info.noc)
+    for x in _samples(data, bits, info.comp, start, end):
+        gating.feed(x)
+    stats = gating.stats()
+    if not peak_if(stats):
+        return None
+    tp = _TruePeak(rate, info.noc)
+    for x in _samples(data, bits, info.comp, start, end):
+        tp.feed(x)
+    stats["input_tp"] = _input_tp(tp)
+    return stats
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+import util
+
+# Record of what dt_process has already produced, kept in discogs.db so
+# an interrupted or repeated run only redoes what's missing or stale.
+#
+# Every output track is recorded under its input file, the part of that
+# file it came from (the track position for a multi-track side, "" for a
+# single-track file), the output directory and the options that shape
+# the output. It stays valid while
+#   - the input file is unchanged: same size and mtime, or same size and
+#     digest if it was only touched or copied. The digest covers the whole
+#     file, since a repaired click or a re-render changes only a few
+#     blocks. It's worked out once per input and shared with the
+#     loudness analysis cache, and taken from an earlier run's rows
+#     while the size and mtime match,
+#   - the Discogs metadata the tags and file name come from is unchanged,
+#   - the output file still exists.
+
+# dt_process options that change what ends up in an output file
+OUTPUT_OPTIONS = ("format", "legacy_normalize", "write_genre")
+
+def track_signature(track):
+    """Digest of everything the output's tags and name are derived from."""
+    release = track.getRelease()
+    data = [release.fields, release.trackrows[track.index]]
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode("utf-8"),
+            digest_size=16).hexdigest()
+
+class Manifest:
+    def __init__(self, db, config):
+        self.db = db
+        options = {k: config[k] for k in OUTPUT_OPTIONS}
+        # a run into another -o has produced nothing there yet
+        options["outdir"] = os.path.abspath(config["outdir"])
+        self.options = json.dumps(options, sort_keys=True)
+        self.digests = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def digest(self, source, st=None):
+        """Digest of the whole of source, hashed at most once while its
+        size and mtime stay the same."""
+        source = os.path.abspath(source)
+        st = st or os.stat(source)
+        # keyed on size and mtime too, a --watch run sees files rewritten
+        key = (source, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            lock = self.locks.setdefault(source, threading.Lock())
+        # the regions of a side are encoded in parallel
+        with lock:
+            if key not in self.digests:
+                self.digests[key] = (self.db.get_manifest_digest(*key) or
+                        util.file_digest(source))
+            return self.digests[key]
+
+    def is_done(self, source, part, track):
+        """True if track has been produced from this part of source with
+        the current options, and nothing it depends on has changed."""
+        source = os.path.abspath(source)
+        row = self.db.get_manifest(source, part, self.options)
+        if not row:
+            return False
+        if row["tags"] != track_signature(track) or not os.path.exists(row["output"]):
+            return False
+        st = os.stat(source)
+        if st.st_size != row["size"]:
+            return False
+        if st.st_mtime_ns != row["mtime"]:
+            if self.digest(source, st) != row["digest"]:
+                return False
+            self.db.touch_manifest(source, st.st_mtime_ns)
+        return True
+
+    def record(self, source, part, track, output):
+        """Note that output was produced for track from this part of source."""
+        source = os.path.abspath(source)
+        st = os.stat(source)
+        self.db.put_manifest(source, part, self.options, st.st_size,
+                st.st_mtime_ns, self.digest(source, st), track_signature(track), output)
@@ -0,0 +1,131 @@
+import itertools
+import queue
+import threading
+
+# A chain of stages connected by bounded queues. Every stage has its own
+# worker threads, so a slow stage (waiting on the network, the disk or
+# an encoder process) only holds up the items behind it, and the run
+# takes about as long as its slowest stage rather than the sum of all.
+# The bounded queues stop a fast stage from running far ahead of the
+# next one.
+
+class _Done:
+    pass
+
+DONE = _Done()
+
+class Stage:
+    """fn(item) returns the item to pass on, a list of items, or None to
+    drop it. workers threads run fn; up to maxsize items wait in front,
+    taken in order of priority(item) (lowest first) if it's given,
+    otherwise as they came."""
+
+    def __init__(self, name, fn, workers=1, maxsize=None, priority=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.maxsize = maxsize if maxsize is not None else 2 * workers
+        self.priority = priority
+
+class _PriorityQueue(queue.PriorityQueue):
+    """Items ordered by key, then as they came; DONE comes after all."""
+
+    def __init__(self, maxsize, key):
+        super().__init__(maxsize)
+        self.key = key
+        self.seq = itertools.count()
+
+    def put(self, item):
+        if item is DONE:
+            super().put((1, 0, next(self.seq), item))
+        else:
+            super().put((0, self.key(item), next(self.seq), item))
+
+    def get(self):
+        return super().get()[-1]
+
+class Pipeline:
+    def __init__(self, stages, progress=True):
+        self.stages = stages
+        self.queues = [_PriorityQueue(stage.maxsize, stage.priority) if stage.priority
+                else queue.Queue(stage.maxsize) for stage in stages]
+        self.lock = threading.Lock()
+        self.results = []
+        self.failures = []
+        self.queued = [0] * len(stages)
+        self.running = [stage.workers for stage in stages]
+        self.bars = None
+        if progress:
+            import tqdm
+            width = max(len(stage.name) for stage in stages)
+            self.bars = [tqdm.tqdm(total=0, desc=stage.name.ljust(width), position=i,
+                    unit="item", leave=True, dynamic_ncols=True)
+                    for i, stage in enumerate(stages)]
+
+    def _put(self, index, item):
+        if index == len(self.stages):
+            with self.lock:
+                self.results.append(item)
+            return
+        with self.lock:
+            self.queued[index] += 1
+            if self.bars:
+                self.bars[index].total = self.queued[index]
+                self.bars[index].refresh()
+        # blocks while the next stage is backed up
+        self.queues[index].put(item)
+
+    def fail(self, name, item, error):
+        """Record that item failed in stage name. Stages that fan out can
+        call this for one of their outputs and carry on with the rest."""
+        with self.lock:
+            self.failures.append((name, item, error))
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        q = self.queues[index]
+        while True:
+            item = q.get()
+            if item is DONE:
+                # let this stage's other workers see it too
+                q.put(DONE)
+                break
+            try:
+                out = stage.fn(item)
+            except Exception as e:
+                out = None
+                self.fail(stage.name, item, e)
+            if out is not None:
+                for o in (out if isinstance(out, list) else [out]):
+                    self._put(index + 1, o)
+            with self.lock:
+                if self.bars:
+                    self.bars[index].update(1)
+
+        with self.lock:
+            self.running[index] -= 1
+            last = not self.running[index]
+        if last and index + 1 < len(self.stages):
+            self.queues[index + 1].put(DONE)
+
+    def run(self, items):
+        """Push items through every stage. Returns (results of the last
+        stage, failures as (stage name, item, exception))."""
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                t = threading.Thread(target=self._worker, args=(index,),
+                        name="%s-%d" % (stage.name, i), daemon=True)
+                t.start()
+                threads.append(t)
+        for item in items:
+            self._put(0, item)
+        self.queues[0].put(DONE)
+        for t in threads:
+            # a timeout keeps the main thread responsive to Ctrl-C
+            while t.is_alive():
+                t.join(0.5)
+        if self.bars:
+            for bar in self.bars:
+                bar.close()
+        return self.results, self.failures
@@ -0,0 +1,78 @@
+import random
+import threading
+import time
+
+# Discogs allows 60 authenticated requests per minute, measured over a
+# moving 60 second window, and reports the current budget in the
+# X-Discogs-Ratelimit-* headers of every response.
+DISCOGS_WINDOW = 60.0
+
+# HTTP status codes worth retrying after a backoff
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self):
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, limit, remaining):
+        """Adjust the bucket from X-Discogs-Ratelimit / -Remaining headers.
+
+        Either value may be None (or a header string) when the response
+        didn't carry it.
+        """
+        with self.lock:
+            self._refill()
+            if limit:
+                limit = int(limit)
+                if limit > 0:
+                    self.rate = limit / DISCOGS_WINDOW
+            if remaining is not None:
+                # Never spend more than the server says is left in the
+                # window; other processes may share the same budget.
+                self.tokens = min(self.tokens, float(int(remaining)))
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server answered 429."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter for retry number `attempt` (from 0)."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def retry_after(value):
+    """Seconds asked for by a Retry-After header, or 0 if there's none
+    (or it's an HTTP date, which Discogs doesn't send)."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+# Separate budgets: the JSON API is limited per user by Discogs, the
+# image CDN is throttled independently.
+api_limiter = TokenBucket(60 / DISCOGS_WINDOW, 5)
+image_limiter = TokenBucket(1.0, 4)
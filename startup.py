@@ -0,0 +1,54 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+# --profile-startup: run the same command again under python -X importtime
+# and report which imports its time went to, including the ones deferred
+# until an option needed them.
+
+# Set in the profiled child, see profiling()
+CHILD_ENV = "DISCOGSTOOL_PROFILE_STARTUP"
+
+importtime_regex = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def profiling():
+    """True in a command being profiled. Its pool workers aren't: their
+    import times would be mixed in with its own."""
+    if not os.environ.get(CHILD_ENV):
+        return False
+    # read by multiprocessing when it starts a worker interpreter
+    sys._xoptions.pop("importtime", None)
+    return True
+
+def profile(script, argv, top=20):
+    """Run script with argv under -X importtime, passing its other output
+    through, then print the slowest imports. Returns its exit status."""
+    env = dict(os.environ, **{CHILD_ENV: "1"})
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", script] + argv,
+            stderr=subprocess.PIPE, env=env, text=True)
+    imports = []
+    for line in proc.stderr:
+        m = importtime_regex.match(line)
+        if m:
+            self_us, cumulative_us, indent, name = m.groups()
+            imports.append((len(indent), int(self_us), int(cumulative_us), name))
+        elif not line.startswith("import time: self"):
+            sys.stderr.write(line)
+    status = proc.wait()
+    elapsed = time.perf_counter() - start
+
+    # the least indented entries are the ones the command (or the
+    # interpreter's own startup) imported directly
+    depth = min((i[0] for i in imports), default=0)
+    outer = sorted((i for i in imports if i[0] == depth), key=lambda i: -i[2])
+    total = sum(i[2] for i in outer)
+    print()
+    print("Imports: %.1f ms in %d modules (whole run %.2f s)" %
+            (total / 1000, len(imports), elapsed))
+    print("%12s %10s  %s" % ("cumulative", "self", "module"))
+    for indent, self_us, cumulative_us, name in outer[:top]:
+        print("%9.1f ms %7.1f ms  %s" % (cumulative_us / 1000, self_us / 1000, name))
+    return status
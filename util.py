@@ -1,10 +1,14 @@
 import os
 import csv
+import hashlib
 
 datapath = os.path.expanduser(os.path.join("~",".discogstool"))
 
-if not os.path.exists(datapath):
-    os.mkdir(datapath)
+def ensure_datapath():
+    """Create ~/.discogstool if needed, before writing anything there.
+    Not done at import, so --help and the like leave the home alone."""
+    os.makedirs(datapath, exist_ok=True)
+    return datapath
 
 def userfile(fname):
     return os.path.join(datapath, fname)
@@ -13,10 +17,23 @@ def file_extension(path):
     _, ext = os.path.splitext(path)
     return ext[1:].lower()
 
+# file_digest() reads this much at a time
+DIGEST_BLOCK = 1 << 20
+
+def file_digest(path):
+    """Hex digest of every byte of a file, read a block at a time."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fo:
+        for block in iter(lambda: fo.read(DIGEST_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
 def get_audio_files(basedir):
     filelist = []
 
     for root, dirs, files in os.walk(basedir):
+        # e.g. the staging directory of a dt_process run into basedir
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
         for fname in files:
             if fname.startswith("."):
                 continue
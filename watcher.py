@@ -0,0 +1,115 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# Watching a directory for recordings as they're exported into it. On
+# Linux inotify says when a file has been closed after writing (or moved
+# in); elsewhere the directory is polled, and a file counts as done once
+# its size and mtime stop changing.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+_event = struct.Struct("iIII")
+
+class _Inotify:
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # AttributeError where there's no inotify
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed for %s" % directory)
+
+    def wait(self, timeout):
+        """Names of the files finished in the next timeout seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = data[pos:pos + size].rstrip(b"\0")
+            pos += size
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+def _scan(directory):
+    """Size and mtime of every file in directory, by name."""
+    files = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                if entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+    return files
+
+class _Poller:
+    def __init__(self, directory):
+        self.directory = directory
+        self.previous = _scan(directory)
+        self.reported = dict(self.previous)
+
+    def wait(self, timeout):
+        """Names of the files that stopped changing in the last timeout
+        seconds."""
+        time.sleep(timeout)
+        current = _scan(self.directory)
+        names = [name for name, st in current.items()
+                if st == self.previous.get(name) and st != self.reported.get(name)]
+        self.reported.update((name, current[name]) for name in names)
+        self.previous = current
+        return names
+
+def watch(directory, settle=2.0, polling=False):
+    """Yield lists of paths of files written to directory. Files that
+    arrive close together come as one list, once none has arrived for
+    settle seconds. The files already there are the first list."""
+    source = None
+    if not polling:
+        try:
+            source = _Inotify(directory)
+        except (OSError, AttributeError, TypeError):
+            pass
+    if source is None:
+        source = _Poller(directory)
+
+    # The files already there may still be being written. Only the ones
+    # that stay the same for settle seconds are the first list; the
+    # others come up once they're finished, like any new file.
+    existing = {name: st for name, st in _scan(directory).items()
+            if not name.startswith(".")}
+    pending = []
+    if existing:
+        time.sleep(settle)
+        current = _scan(directory)
+        pending = [os.path.join(directory, name) for name in sorted(existing)
+                if current.get(name) == existing[name]]
+    if pending:
+        yield pending
+        pending = []
+
+    while True:
+        names = [name for name in source.wait(settle) if not name.startswith(".")]
+        for name in names:
+            path = os.path.join(directory, name)
+            if path not in pending:
+                pending.append(path)
+        if pending and not names:
+            yield pending
+            pending = []
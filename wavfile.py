@@ -18,6 +18,11 @@
 #
 # * removed RIFX support (big-endian) (never seen one in 10+ years of audio production/audio programming), only RIFF (little-endian) are supported
 # * removed read(..., mmap)
+# * read: mmap=True returns a read-only numpy.memmap over the data chunk instead of loading it
+#         (24 bit: an Int24View that decodes to int32 only the slices that are indexed)
+# * scan: header-only walk of the chunks, returns format, data chunk offset/size, markers and loops
+# * write_region: copies a range of frames byte for byte from another wav file, only a new header is written
+# * fmt: WAVE_FORMAT_EXTENSIBLE files report the format tag of their SubFormat
 #
 #
 # Test:
@@ -36,6 +41,7 @@ Functions
 """
 from __future__ import division, print_function, absolute_import
 
+import os
 import numpy
 import struct
 import warnings
@@ -52,9 +58,17 @@ _ieee = False
 def _read_fmt_chunk(fid):
     res = struct.unpack('<IhHIIHH',fid.read(20))
     size, comp, noc, rate, sbytes, ba, bits = res
+    global _ieee
+    _ieee = False
+    if (comp == -2 and size >= 40):
+        # WAVE_FORMAT_EXTENSIBLE: the real format tag leads the SubFormat GUID
+        cbsize, validbits, chmask, comp = struct.unpack('<HHIH', fid.read(10))
+        fid.read(14)
+        size -= 24
+        if comp == 1 and size == 16:
+            return size, comp, noc, rate, sbytes, ba, bits
     if (comp != 1 or size > 16):
         if (comp == 3):
-          global _ieee
           _ieee = True
           #warnings.warn("IEEE format not supported", WavFileWarning)        
         else: 
@@ -63,9 +77,46 @@ def _read_fmt_chunk(fid):
             fid.read(size-16)
     return size, comp, noc, rate, sbytes, ba, bits
 
+def _decode24(raw):
+    """Decode packed little-endian 24 bit samples, shape (..., 3) uint8, to int32."""
+    a = numpy.empty(raw.shape[:-1] + (4,), dtype='u1')
+    a[..., :3] = raw
+    a[..., 3] = (raw[..., 2] >> 7) * 255          # sign extension
+    return a.view('<i4').reshape(raw.shape[:-1])
+
+class Int24View(object):
+    """
+    Lazy view over packed 24 bit sample data (e.g. a numpy.memmap).
+
+    Indexes like the (N,) or (N, channels) int32 array read() would
+    return, but only decodes the samples that are actually indexed.
+    """
+    dtype = numpy.dtype('<i4')
+
+    def __init__(self, raw, noc):
+        # frames x channels x 3 bytes, or frames x 3 bytes for mono
+        if noc > 1:
+            self.raw = raw.reshape(-1, noc, 3)
+        else:
+            self.raw = raw.reshape(-1, 3)
+        self.shape = self.raw.shape[:-1]
+        self.ndim = len(self.shape)
+        # byte offset of the data in the file, like numpy.memmap.offset
+        self.offset = getattr(raw, 'offset', 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return _decode24(self.raw[key])
+
+    def __array__(self, dtype=None, copy=None):
+        data = _decode24(self.raw)
+        return data if dtype is None else data.astype(dtype)
+
 # assumes file pointer is immediately
 #   after the 'data' id
-def _read_data_chunk(fid, noc, bits, normalized=False):
+def _read_data_chunk(fid, noc, bits, normalized=False, mmap=False):
     size = struct.unpack('<I',fid.read(4))[0]
 
     if bits == 8 or bits == 24:
@@ -78,16 +129,25 @@ def _read_data_chunk(fid, noc, bits, normalized=False):
     if bits == 32 and _ieee:
        dtype = 'float32'
     #print("size bytes", size, bytes)
-    data = numpy.fromfile(fid, dtype=dtype, count=size//bytes)
+    if mmap:
+        count = size // bytes
+        if bits == 24:
+            count -= count % (3 * noc)          # whole frames only
+        offset = fid.tell()
+        data = numpy.memmap(fid, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        fid.seek(offset + size)
+        if bits == 24:
+            data = Int24View(data, noc)
+        elif noc > 1:
+            data = data.reshape(-1,noc)
+    else:
+        data = numpy.fromfile(fid, dtype=dtype, count=size//bytes)
     
-    if bits == 24:
-        a = numpy.empty((len(data) // 3, 4), dtype='u1')
-        a[:, :3] = data.reshape((-1, 3))
-        a[:, 3:] = (a[:, 3 - 1:3] >> 7) * 255
-        data = a.view('<i4').reshape(a.shape[:-1])
+        if bits == 24:
+            data = _decode24(data.reshape((-1, 3)))
     
-    if noc > 1:
-        data = data.reshape(-1,noc)
+        if noc > 1:
+            data = data.reshape(-1,noc)
         
     if bool(size & 1):     # if odd number of bytes, move 1 byte further (data chunk is word-aligned)
       fid.seek(1,1)    
@@ -99,6 +159,12 @@ def _read_data_chunk(fid, noc, bits, normalized=False):
 
     return data
 
+def _skip_data_chunk(fid):
+    size = struct.unpack('<I', fid.read(4))[0]
+    offset = fid.tell()
+    fid.seek(size + (size & 1), 1)      # data chunk is word-aligned
+    return offset, size
+
 def _skip_unknown_chunk(fid):
     data = fid.read(4)
     size = struct.unpack('<I', data)[0]
@@ -117,40 +183,18 @@ def _read_riff_chunk(fid):
     return fsize
 
 
-def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False, readloops=False, readpitch=False, normalized=False, forcestereo=False):
-    """
-    Return the sample rate (in samples/sec) and data from a WAV file
-
-    Parameters
-    ----------
-    file : file
-        Input wav file.
-
-    Returns
-    -------
-    rate : int
-        Sample rate of wav file
-    data : numpy array
-        Data read from wav file
-
-    Notes
-    -----
-
-    * The file can be an open file or a filename.
-
-    * The returned sample rate is a Python integer
-    * The data is returned as a numpy array with a
-      data-type determined from the file.
-
-    """
-    if hasattr(file,'read'):
-        fid = file
-    else:
-        fid = open(file, 'rb')
-
+# walks the RIFF chunks of fid; read_data(fid, noc, bits) is called
+#   with the file pointer after the 'data' id, or the data chunk is
+#   skipped by seeking if read_data is None
+def _read_chunks(fid, read_data=None):
     fsize = _read_riff_chunk(fid)
     noc = 1
     bits = 8
+    comp = 1
+    rate = 0
+    data = None
+    data_offset = 0
+    data_size = 0
     #_cue = []
     #_cuelabels = []
     _markersdict = collections.defaultdict(lambda: {'position': -1, 'label': '', 'length': 0})
@@ -162,7 +206,10 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
         if chunk_id == b'fmt ':
             size, comp, noc, rate, sbytes, ba, bits = _read_fmt_chunk(fid)
         elif chunk_id == b'data':
-            data = _read_data_chunk(fid, noc, bits, normalized)
+            if read_data:
+                data = read_data(fid, noc, bits)
+            else:
+                data_offset, data_size = _skip_data_chunk(fid)
         elif chunk_id == b'cue ':
             str1 = fid.read(8)
             size, numcue = struct.unpack('<ii',str1)
@@ -209,14 +256,64 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
                 loops.append([start, end])
         else:
             _skip_unknown_chunk(fid)
-    fid.close()
-
-    if data.ndim == 1 and forcestereo:
-        data = numpy.column_stack((data, data))
 
     _markerslist = sorted([_markersdict[l] for l in _markersdict], key=lambda k: k['position'])  # sort by position
     _cue = [m['position'] for m in _markerslist]
     _cuelabels = [m['label'] for m in _markerslist]
+
+    return {'rate': rate, 'noc': noc, 'bits': bits, 'comp': comp, 'data': data,
+            'data_offset': data_offset, 'data_size': data_size, 'markers': _cue,
+            'markerlabels': _cuelabels, 'markerslist': _markerslist, 'loops': loops,
+            'pitch': pitch}
+
+def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False, readloops=False, readpitch=False, normalized=False, forcestereo=False, mmap=False):
+    """
+    Return the sample rate (in samples/sec) and data from a WAV file
+
+    Parameters
+    ----------
+    file : file
+        Input wav file.
+
+    Returns
+    -------
+    rate : int
+        Sample rate of wav file
+    data : numpy array
+        Data read from wav file
+
+    Notes
+    -----
+
+    * The file can be an open file or a filename.
+
+    * The returned sample rate is a Python integer
+    * The data is returned as a numpy array with a
+      data-type determined from the file.
+    * With mmap=True the data is a read-only numpy.memmap over the file
+      (an Int24View for 24 bit files), nothing is read until it is
+      indexed. Can't be combined with normalized or forcestereo.
+
+    """
+    if mmap and (normalized or forcestereo):
+        raise ValueError("mmap can't be combined with normalized or forcestereo")
+
+    if hasattr(file,'read'):
+        fid = file
+    else:
+        fid = open(file, 'rb')
+
+    try:
+        info = _read_chunks(fid, lambda fid, noc, bits: _read_data_chunk(fid, noc, bits, normalized, mmap))
+    finally:
+        fid.close()
+
+    rate, data, bits = info['rate'], info['data'], info['bits']
+    if data.ndim == 1 and forcestereo:
+        data = numpy.column_stack((data, data))
+
+    _cue, _cuelabels, _markerslist = info['markers'], info['markerlabels'], info['markerslist']
+    loops, pitch = info['loops'], info['pitch']
     
     return (rate, data, bits, ) \
         + ((_cue,) if readmarkers else ()) \
@@ -225,7 +322,51 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
         + ((loops,) if readloops else ()) \
         + ((pitch,) if readpitch else ())
 
-  
+
+WavInfo = collections.namedtuple('WavInfo', ['rate', 'noc', 'bits', 'comp',
+        'data_offset', 'data_size', 'frames', 'markers', 'markerlabels',
+        'markerslist', 'loops', 'pitch'])
+
+def scan(file):
+    """
+    Return the format, data chunk location, markers and loops of a WAV file
+    without reading any sample data
+
+    Parameters
+    ----------
+    file : file
+        Input wav file, an open file or a filename.
+
+    Returns
+    -------
+    info : WavInfo
+        rate, noc (channels), bits, comp (format tag), data_offset and
+        data_size (in bytes) of the data chunk, frames, and the markers,
+        markerlabels, markerslist, loops and pitch that read() returns.
+
+    Notes
+    -----
+    * Only the chunk headers and metadata chunks are read, the data
+      chunk is skipped by seeking, so this takes the same time for any
+      file length.
+
+    """
+    if hasattr(file,'read'):
+        fid = file
+    else:
+        fid = open(file, 'rb')
+
+    try:
+        info = _read_chunks(fid)
+    finally:
+        fid.close()
+
+    ba = info['noc'] * (info['bits'] // 8)
+    return WavInfo(info['rate'], info['noc'], info['bits'], info['comp'],
+            info['data_offset'], info['data_size'], info['data_size'] // ba if ba else 0,
+            info['markers'], info['markerlabels'], info['markerslist'],
+            info['loops'], info['pitch'])
+
 
 def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=None, normalized=False):
     """
@@ -342,11 +483,73 @@ def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=No
     data.tofile(fid)
 
     if data.nbytes % 2 == 1: # add an extra padding byte if data.nbytes is odd: https://web.archive.org/web/20141226210234/http://www.sonicspot.com/guide/wavefiles.html#data
-        fid.write('\x00')
+        fid.write(b'\x00')
 
     # Determine file size and place it in correct
     #  position at start of the file.
     size = fid.tell()
     fid.seek(4)
     fid.write(struct.pack('<I', size-8))
-    fid.close()
\ No newline at end of file
+    fid.close()
+
+
+def _copy_bytes(fsrc, fdst, offset, count):
+    """Copy count bytes from offset in fsrc to the current position of fdst."""
+    fdst.flush()
+    if hasattr(os, 'copy_file_range'):        # Linux: copied in the kernel, or reflinked
+        try:
+            while count > 0:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), count, offset)
+                if n == 0:
+                    break
+                offset += n
+                count -= n
+        except OSError:
+            pass                                # e.g. EXDEV on older kernels, finish below
+        fdst.seek(0, 2)                         # resync with the fd position
+    fsrc.seek(offset)
+    while count > 0:
+        buf = fsrc.read(min(count, 1 << 20))
+        if not buf:
+            raise ValueError("Source wav file is truncated")
+        fdst.write(buf)
+        count -= len(buf)
+
+
+def write_region(filename, src, offset, rate, noc, bits, start, end, comp=1):
+    """
+    Write frames [start, end) of another WAV file's data chunk as a new WAV file
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file to write (will be over-written).
+    src : str
+        The source wav file.
+    offset : int
+        Byte offset of the first sample of the source data chunk.
+    rate, noc, bits, comp : int
+        Sample rate, number of channels, bits per sample and format tag
+        (1 = PCM, 3 = IEEE float) of the source.
+    start, end : int
+        Frame range to copy, end not inclusive.
+
+    Notes
+    -----
+    * The samples are copied as raw bytes and never decoded, so memory
+      use is constant whatever the region length or bit depth.
+
+    """
+    ba = noc * (bits // 8)
+    nbytes = (end - start) * ba
+    pad = nbytes % 2
+
+    header = b'RIFF' + struct.pack('<I', 4 + 8 + 16 + 8 + nbytes + pad) + b'WAVE'
+    header += b'fmt ' + struct.pack('<IhHIIHH', 16, comp, noc, rate, rate * ba, ba, bits)
+    header += b'data' + struct.pack('<I', nbytes)
+
+    with open(src, 'rb') as fsrc, open(filename, 'wb') as fdst:
+        fdst.write(header)
+        _copy_bytes(fsrc, fdst, offset + start * ba, nbytes)
+        if pad:
+            fdst.write(b'\x00')